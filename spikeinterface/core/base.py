@@ -727,6 +727,9 @@ class BaseExtractor:
             If True (default), the output is verbose.
         zarr_path: str, Path, or None
             (Deprecated) Name of the zarr folder (.zarr). 
+        compression_profile: "fast", "balanced", or "small"
+            Compressor settings used when no 'compressor' is given: "fast" (lz4) writes faster,
+            "small" (zstd level 9) compresses more. Default "balanced" (zstd level 5)
         
         Returns
         -------
@@ -783,15 +786,26 @@ class BaseExtractor:
         cached = self._save(verbose=verbose, **save_kwargs)
         cached_annotations = deepcopy(cached._annotations)
 
-        # save properties
-        prop_group = zarr_root.create_group('properties')
+        # save properties: they are first encoded in memory and then sent to the store in one batch
+        # (a single request for remote stores) instead of several writes per property
+        prop_store = zarr.MemoryStore()
+        prop_group = zarr.group(store=prop_store).create_group('properties')
         for key in self.get_property_keys():
             values = self.get_property(key)
             prop_group.create_dataset(name=key, data=values, compressor=None)
+        prop_items = {key: prop_store[key] for key in prop_store.keys() if key.startswith('properties/')}
+        if hasattr(zarr_root.store, 'setitems'):
+            zarr_root.store.setitems(prop_items)
+        else:
+            for key, value in prop_items.items():
+                zarr_root.store[key] = value
 
         # save annotations
         zarr_root.attrs["annotations"] = check_json(self._annotations)
 
+        # gather all metadata in a single key, so that the root can be opened with one read
+        zarr.consolidate_metadata(zarr_root.store)
+
         # copy properties/
         self.copy_metadata(cached)
         # append annotations on compression
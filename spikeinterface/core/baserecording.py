@@ -239,8 +239,13 @@ class BaseRecording(BaseRecordingSnippets):
             cached = NumpyRecording(traces_list, self.get_sampling_frequency(), t_starts=t_starts, channel_ids=self.channel_ids)
 
         elif format == 'zarr':
-            from .zarrrecordingextractor import get_default_zarr_compressor, ZarrRecordingExtractor
+            import zarr
+            from .zarrrecordingextractor import (get_default_zarr_compressor, zarr_compression_profiles,
+                                                 ZarrRecordingExtractor)
             zarr_kwargs = kwargs.copy()
+            compression_profile = zarr_kwargs.pop('compression_profile', 'balanced')
+            assert compression_profile in zarr_compression_profiles, \
+                f"'compression_profile' must be one of {list(zarr_compression_profiles.keys())}"
             
             zarr_root = zarr_kwargs['zarr_root']
             zarr_root.attrs["sampling_frequency"] = float(self.get_sampling_frequency())
@@ -251,7 +256,8 @@ class BaseRecording(BaseRecordingSnippets):
             zarr_kwargs['dtype'] = kwargs.get('dtype', None) or self.get_dtype()
             
             if 'compressor' not in zarr_kwargs:
-                zarr_kwargs['compressor'] = compressor = get_default_zarr_compressor()
+                compressor = get_default_zarr_compressor(**zarr_compression_profiles[compression_profile])
+                zarr_kwargs['compressor'] = compressor
                 print(f"Using default zarr compressor: {compressor}. To use a different compressor, use the "
                       f"'compressor' argument")
 
@@ -278,7 +284,9 @@ class BaseRecording(BaseRecordingSnippets):
                 zarr_root.create_dataset(name="t_starts", data=t_starts,
                                          compressor=None)
 
-            cached = ZarrRecordingExtractor(zarr_kwargs['zarr_path'], zarr_kwargs['storage_options'])
+            # the cached recording gets a read-only view on the same store (no new connection)
+            cached = ZarrRecordingExtractor(zarr_kwargs['zarr_path'], zarr_kwargs['storage_options'],
+                                            zarr_root=zarr.open_group(zarr_root.store, mode="r"))
 
         elif format == 'nwb':
             # TODO implement a format based on zarr
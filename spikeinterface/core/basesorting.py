@@ -248,7 +248,7 @@ class BaseSorting(BaseExtractor):
                     unit_id=unit_id, segment_index=segment_index)
                 spike_times.append(st)
                 if outputs == 'unit_id':
-                    spike_labels.append(np.array([unit_id] * st.size))
+                    spike_labels.append(np.full(st.size, unit_id))
                 elif outputs == 'unit_index':
                     spike_labels.append(np.zeros(st.size, dtype='int64') + i)
 
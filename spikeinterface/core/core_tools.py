@@ -3,7 +3,6 @@ import os
 import sys
 import datetime
 from copy import deepcopy
-import gc
 
 import numpy as np
 from tqdm import tqdm
@@ -576,8 +575,8 @@ def write_to_h5_dataset_format(recording, dataset_path, segment_index, save_path
 def write_traces_to_zarr(recording, zarr_root, zarr_path, storage_options, 
                          dataset_paths, channel_chunk_size=None, dtype=None,
                          compressor=None, filters=None, 
-                         verbose=False, auto_cast_uint=True, 
-                         **job_kwargs):
+                         verbose=False, auto_cast_uint=True, io_concurrency=1,
+                         remote_buffer_mb=8, **job_kwargs):
     '''
     Save the trace of a recording extractor in several zarr format.
 
@@ -606,6 +605,14 @@ def write_traces_to_zarr(recording, zarr_root, zarr_path, storage_options,
         If True, output is verbose (when chunks are used)
     auto_cast_uint: bool
         If True (default), unsigned integers are automatically cast to int if the specified dtype is signed
+    io_concurrency: int
+        Number of threads per worker that compress and store concurrently the zarr chunks
+        written by each job (e.g. when channel_chunk_size is used). Default 1 (sequential writes)
+    remote_buffer_mb: float or None
+        For remote stores (storage_options is not None), each job writes at least this amount of
+        (uncompressed) data, i.e. several zarr chunks if they are small, so that the
+        zarr chunks are sent to the store in one batch (`setitems`) instead of one request each.
+        None to write one zarr chunk per job. Default 8
     {}
     '''
     assert dataset_paths is not None, "Provide 'file_path'"
@@ -637,20 +644,32 @@ def write_traces_to_zarr(recording, zarr_root, zarr_path, storage_options,
                                      compressor=compressor,)
                                 # synchronizer=zarr.ThreadSynchronizer())
 
+    # the executor writes whole zarr chunks (all channels if channel_chunk_size is None) in each job,
+    # so that zarr never has to read back and merge partially written chunks
+    job_kwargs = {k: v for k, v in job_kwargs.items() if k not in ('total_memory', 'chunk_memory', 'chunk_duration')}
+    job_kwargs['chunk_size'] = chunk_size
+    if storage_options is not None and remote_buffer_mb is not None and chunk_size is not None:
+        # group small zarr chunks in each job: remote stores pay a latency per request
+        zarr_chunk_bytes = chunk_size * recording.get_num_channels() * np.dtype(dtype).itemsize
+        zarr_chunks_per_job = max(1, int(np.ceil(remote_buffer_mb * 1024 ** 2 / zarr_chunk_bytes)))
+        job_kwargs['chunk_size'] = chunk_size * zarr_chunks_per_job
+
     # use executor (loop or workers)
     func = _write_zarr_chunk
     init_func = _init_zarr_worker
     if n_jobs == 1:
-        init_args = (recording, zarr_path, storage_options, dataset_paths, dtype, cast_unsigned)
+        init_args = (recording, zarr_path, storage_options, dataset_paths, dtype, cast_unsigned, io_concurrency)
     else:
-        init_args = (recording.to_dict(), zarr_path, storage_options, dataset_paths, dtype, cast_unsigned)
+        init_args = (recording.to_dict(), zarr_path, storage_options, dataset_paths, dtype, cast_unsigned,
+                     io_concurrency)
     executor = ChunkRecordingExecutor(recording, func, init_func, init_args, verbose=verbose,
                                       job_name='write_zarr_recording', **job_kwargs)
     executor.run()
 
 
 # used by write_zarr_recording + ChunkRecordingExecutor
-def _init_zarr_worker(recording, zarr_path, storage_options, dataset_paths, dtype, cast_unsigned):
+def _init_zarr_worker(recording, zarr_path, storage_options, dataset_paths, dtype, cast_unsigned,
+                      io_concurrency=1):
     import zarr
 
     # create a local dict per worker
@@ -679,6 +698,9 @@ def _init_zarr_worker(recording, zarr_path, storage_options, dataset_paths, dtyp
     worker_ctx['zarr_datasets'] = zarr_datasets
     worker_ctx['dtype'] = np.dtype(dtype)
     worker_ctx['cast_unsigned'] = cast_unsigned
+    # buffer for the traces cast to dtype, allocated once and reused for all chunks of the worker
+    worker_ctx['cast_buffer'] = np.empty((0, worker_ctx['recording'].get_num_channels()), dtype=dtype)
+    worker_ctx['io_concurrency'] = io_concurrency
 
     return worker_ctx
 
@@ -690,16 +712,41 @@ def _write_zarr_chunk(segment_index, start_frame, end_frame, worker_ctx):
     dtype = worker_ctx['dtype']
     zarr_dataset = worker_ctx['zarr_datasets'][segment_index]
     cast_unsigned = worker_ctx['cast_unsigned']
+    assert start_frame % zarr_dataset.chunks[0] == 0, "zarr writes must be aligned with the zarr chunks"
 
     # apply function
     traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame, segment_index=segment_index,
                                   cast_unsigned=cast_unsigned)
-    traces = traces.astype(dtype)
-    zarr_dataset[start_frame:end_frame, :] = traces
-
-    # fix memory leak by forcing garbage collection
-    del traces
-    gc.collect()
+    num_frames = traces.shape[0]
+    if traces.dtype == dtype:
+        # already in the output dtype (the common case): no copy needed
+        cast_traces = traces
+    else:
+        if worker_ctx['cast_buffer'].shape[0] < num_frames:
+            worker_ctx['cast_buffer'] = np.empty((num_frames, traces.shape[1]), dtype=dtype)
+        cast_traces = worker_ctx['cast_buffer'][:num_frames]
+        np.copyto(cast_traces, traces, casting='unsafe')
+
+    io_concurrency = worker_ctx['io_concurrency']
+    if io_concurrency <= 1:
+        zarr_dataset[start_frame:end_frame, :] = cast_traces
+    else:
+        # one write per zarr chunk by several threads: the compression of one chunk overlaps with the
+        # storage (e.g. network upload) of the others. The threads are joined when the job returns.
+        from concurrent.futures import ThreadPoolExecutor
+        frame_chunk_size, channel_chunk_size = zarr_dataset.chunks
+        with ThreadPoolExecutor(max_workers=io_concurrency) as io_executor:
+            futures = []
+            for chunk_start in range(0, num_frames, frame_chunk_size):
+                chunk_end = min(chunk_start + frame_chunk_size, num_frames)
+                for channel_start in range(0, cast_traces.shape[1], channel_chunk_size):
+                    channel_end = channel_start + channel_chunk_size
+                    selection = (slice(start_frame + chunk_start, start_frame + chunk_end),
+                                 slice(channel_start, channel_end))
+                    futures.append(io_executor.submit(zarr_dataset.__setitem__, selection,
+                                                      cast_traces[chunk_start:chunk_end, channel_start:channel_end]))
+            for future in futures:
+                future.result()
 
 
 def determine_cast_unsigned(recording, dtype):
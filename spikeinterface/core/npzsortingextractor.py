@@ -23,17 +23,16 @@ class NpzSortingExtractor(BaseSorting):
 
         self.npz_filename = file_path
 
-        npz = np.load(file_path)
-        num_segment = int(npz['num_segment'][0])
-        unit_ids = npz['unit_ids']
-        sampling_frequency = float(npz['sampling_frequency'][0])
+        # only the metadata are read here, the spikes of each segment are loaded at the first query
+        with np.load(file_path) as npz:
+            num_segment = int(npz['num_segment'][0])
+            unit_ids = npz['unit_ids']
+            sampling_frequency = float(npz['sampling_frequency'][0])
 
         BaseSorting.__init__(self, sampling_frequency, unit_ids)
 
         for seg_index in range(num_segment):
-            spike_indexes = npz[f'spike_indexes_seg{seg_index}']
-            spike_labels = npz[f'spike_labels_seg{seg_index}']
-            sorting_segment = NpzSortingSegment(spike_indexes, spike_labels)
+            sorting_segment = NpzSortingSegment(file_path, seg_index)
             self.add_sorting_segment(sorting_segment)
 
         self._kwargs = {'file_path': str(Path(file_path).absolute())}
@@ -52,9 +51,8 @@ class NpzSortingExtractor(BaseSorting):
             spike_labels = []
             for unit_id in units_ids:
                 sp_ind = sorting.get_unit_spike_train(unit_id, segment_index=seg_index)
-                spike_indexes.append(sp_ind.astype('int64'))
-                # spike_labels.append(np.ones(sp_ind.size, dtype='int64')*unit_id)
-                spike_labels.append(np.array([unit_id] * sp_ind.size))
+                spike_indexes.append(sp_ind.astype('int64', copy=False))
+                spike_labels.append(np.full(sp_ind.size, unit_id))
 
             # order times
             if len(spike_indexes) > 0:
@@ -73,19 +71,52 @@ class NpzSortingExtractor(BaseSorting):
 
 
 class NpzSortingSegment(BaseSortingSegment):
-    def __init__(self, spike_indexes, spike_labels):
+    def __init__(self, file_path, segment_index):
         BaseSortingSegment.__init__(self)
 
-        self.spike_indexes = spike_indexes
-        self.spike_labels = spike_labels
+        self._file_path = file_path
+        self._segment_index = segment_index
+        self._spike_indexes = None
+        self._spike_labels = None
+        # spike indexes grouped by unit and sorted, computed at the first query
+        self._sorted_spike_indexes = None
+        self._unit_slices = None
+
+    def _load_spikes(self):
+        with np.load(self._file_path) as npz:
+            self._spike_indexes = npz[f'spike_indexes_seg{self._segment_index}']
+            self._spike_labels = npz[f'spike_labels_seg{self._segment_index}']
+
+    @property
+    def spike_indexes(self):
+        if self._spike_indexes is None:
+            self._load_spikes()
+        return self._spike_indexes
+
+    @property
+    def spike_labels(self):
+        if self._spike_labels is None:
+            self._load_spikes()
+        return self._spike_labels
+
+    def _group_spikes_by_unit(self):
+        order = np.lexsort((self.spike_indexes, self.spike_labels))
+        self._sorted_spike_indexes = self.spike_indexes[order].astype('int64')
+        labels, starts, counts = np.unique(self.spike_labels[order], return_index=True, return_counts=True)
+        self._unit_slices = {label: slice(start, start + count)
+                             for label, start, count in zip(labels.tolist(), starts, counts)}
 
     def get_unit_spike_train(self, unit_id, start_frame, end_frame):
-        spike_times = self.spike_indexes[self.spike_labels == unit_id]
+        if self._unit_slices is None:
+            self._group_spikes_by_unit()
+        unit_slice = self._unit_slices.get(unit_id, slice(0, 0))
+        spike_times = self._sorted_spike_indexes[unit_slice]
+        # the spikes of each unit are sorted: the frame limits are found by bisection
         if start_frame is not None:
-            spike_times = spike_times[spike_times >= start_frame]
+            spike_times = spike_times[np.searchsorted(spike_times, start_frame, side='left'):]
         if end_frame is not None:
-            spike_times = spike_times[spike_times < end_frame]
-        return spike_times.astype('int64')
+            spike_times = spike_times[:np.searchsorted(spike_times, end_frame, side='left')]
+        return spike_times.copy()
 
 
 read_npz_sorting = define_function_from_class(source_class=NpzSortingExtractor, name="read_npz_sorting")
@@ -258,11 +258,25 @@ def test_BaseRecording():
     rec_zarr = rec2.save(format="zarr", folder=cache_folder / "recording",
                          compressor=compressor)
     check_recordings_equal(rec2, rec_zarr, return_scaled=False)
+    # the saved recording does not keep the store opened for writing
+    assert rec_zarr._root.read_only
+    # a property added after saving is not in the consolidated metadata: they are not used
+    import zarr
+    zarr.open(str(cache_folder / "recording.zarr"), mode="r+")["properties"].create_dataset(
+        "added_after_saving", data=np.arange(rec2.get_num_channels()))
+    with pytest.warns(UserWarning):
+        rec_zarr_modified = load_extractor(rec_zarr.to_dict())
+    assert np.array_equal(rec_zarr_modified.get_property("added_after_saving"), np.arange(rec2.get_num_channels()))
 
     rec_zarr2 = rec2.save(format="zarr", folder=cache_folder / "recording_channel_chunk",
                           compressor=compressor, channel_chunk_size=2)
     check_recordings_equal(rec2, rec_zarr2, return_scaled=False)
 
+    # concurrent writes of the zarr chunks of each job
+    rec_zarr3 = rec2.save(format="zarr", folder=cache_folder / "recording_io_concurrency",
+                          compressor=compressor, channel_chunk_size=2, chunk_size=1000, io_concurrency=4)
+    check_recordings_equal(rec2, rec_zarr3, return_scaled=False)
+
     # test cast unsigned
     rec_u = rec_uint16.save(format="zarr", folder=cache_folder / "rec_u")
     rec_u.get_dtype() == 'uint16'
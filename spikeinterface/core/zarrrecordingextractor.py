@@ -1,6 +1,8 @@
 from typing import List, Union
 
 from pathlib import Path
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from probeinterface import ProbeGroup
 
 import numpy as np
@@ -25,6 +27,9 @@ class ZarrRecordingExtractor(BaseRecording):
         Path to the zarr root file
     storage_options: dict or None
         Storage options for zarr `store`. E.g., if "s3://" or "gcs://" they can provide authentication methods, etc.
+    zarr_root: zarr.Group or None
+        An already opened zarr root for `root_path` (e.g. just after saving), to avoid opening the store again.
+        It must be opened read-only (e.g. `zarr.open_group(store, mode="r")`), like the root opened from `root_path`
 
     Returns
     -------
@@ -38,7 +43,7 @@ class ZarrRecordingExtractor(BaseRecording):
     installation_mesg = "To use the ZarrRecordingExtractor install zarr: \n\n pip install zarr\n\n"
     name = "zarr"
 
-    def __init__(self, root_path: Union[Path, str], storage_options=None):
+    def __init__(self, root_path: Union[Path, str], storage_options=None, zarr_root=None):
         assert self.installed, self.installation_mesg
         
         if storage_options is None:
@@ -52,11 +57,25 @@ class ZarrRecordingExtractor(BaseRecording):
             root_path_init = root_path
             root_path_kwarg = root_path_init
         
-        self._root = zarr.open(root_path_init, mode="r", storage_options=storage_options)
+        if zarr_root is not None:
+            assert zarr_root.read_only, "'zarr_root' must be opened in read-only mode"
+            self._root = zarr_root
+        else:
+            try:
+                # consolidated metadata are loaded with a single read
+                self._root = zarr.open_consolidated(root_path_init, mode="r", storage_options=storage_options)
+                if not _consolidated_metadata_is_current(self._root):
+                    warnings.warn(f"The consolidated metadata of {root_path_init} do not match its content "
+                                  "(the folder was modified after saving): they are ignored")
+                    self._root = zarr.open(root_path_init, mode="r", storage_options=storage_options)
+            except KeyError:
+                self._root = zarr.open(root_path_init, mode="r", storage_options=storage_options)
 
         sampling_frequency = self._root.attrs.get("sampling_frequency", None)
         num_segments = self._root.attrs.get("num_segments", None)
-        assert "channel_ids" in self._root.keys(), "'channel_ids' dataset not found!"
+        # list the root keys once instead of probing the store for each optional dataset
+        root_keys = set(self._root.keys())
+        assert "channel_ids" in root_keys, "'channel_ids' dataset not found!"
         channel_ids = self._root["channel_ids"][:]
 
         assert sampling_frequency is not None, "'sampling_frequency' attiribute not found!"
@@ -69,18 +88,19 @@ class ZarrRecordingExtractor(BaseRecording):
         BaseRecording.__init__(self, sampling_frequency, channel_ids, dtype)
 
         dtype = np.dtype(dtype)
-        t_starts = self._root.get("t_starts", None)
+        # the t_starts array is tiny: read it once instead of one read per segment
+        t_starts = self._root["t_starts"][:] if "t_starts" in root_keys else None
 
-        total_nbytes = 0
-        total_nbytes_stored = 0
-        cr_by_segment = {}
         for segment_index in range(num_segments):
             trace_name = f"traces_seg{segment_index}"
-            assert len(channel_ids) == self._root[trace_name].shape[1], \
+            # open the traces array once: each lookup reads its metadata from the store again
+            traces = self._root[trace_name]
+            assert len(channel_ids) == traces.shape[1], \
                 f'Segment {segment_index} has the wrong number of channels!'
 
             time_kwargs = {}
-            time_vector = self._root.get(f"times_seg{segment_index}", None)
+            time_name = f"times_seg{segment_index}"
+            time_vector = self._root[time_name] if time_name in root_keys else None
             if time_vector is not None:
                 time_kwargs["time_vector"] = time_vector
             else:
@@ -93,14 +113,7 @@ class ZarrRecordingExtractor(BaseRecording):
                 time_kwargs["t_start"] = t_start
                 time_kwargs["sampling_frequency"] = sampling_frequency
 
-            rec_segment = ZarrRecordingSegment(self._root, trace_name, **time_kwargs)
-            
-            nbytes_segment = self._root[trace_name].nbytes
-            nbytes_stored_segment = self._root[trace_name].nbytes_stored
-            cr_by_segment[segment_index] = nbytes_segment / nbytes_stored_segment
-            
-            total_nbytes += nbytes_segment
-            total_nbytes_stored += nbytes_stored_segment
+            rec_segment = ZarrRecordingSegment(traces, **time_kwargs)
             self.add_recording_segment(rec_segment)
 
         # load probe
@@ -110,7 +123,7 @@ class ZarrRecordingExtractor(BaseRecording):
             self.set_probegroup(probegroup, in_place=True)
 
         # load properties
-        if 'properties' in self._root:
+        if 'properties' in root_keys:
             prop_group = self._root['properties']
             for key in prop_group.keys():
                 values = self._root['properties'][key]
@@ -121,17 +134,49 @@ class ZarrRecordingExtractor(BaseRecording):
         if annotations is not None:
             self.annotate(**annotations)
         # annotate compression ratios
-        cr = total_nbytes / total_nbytes_stored
+        # sizing the stored chunks lists the store for each segment (slow on remote stores),
+        # so the segments are sized concurrently
+        traces_list = [rec_segment._timeseries for rec_segment in self._recording_segments]
+        if num_segments > 1:
+            with ThreadPoolExecutor(max_workers=min(num_segments, 8)) as executor:
+                nbytes_stored = list(executor.map(_get_nbytes_stored, traces_list))
+        else:
+            nbytes_stored = [_get_nbytes_stored(traces) for traces in traces_list]
+        nbytes = [traces.nbytes for traces in traces_list]
+        cr_by_segment = {segment_index: nbytes[segment_index] / nbytes_stored[segment_index]
+                         for segment_index in range(num_segments)}
+        cr = sum(nbytes) / sum(nbytes_stored)
         self.annotate(compression_ratio=cr, compression_ratio_segments=cr_by_segment)
         
         self._kwargs = {'root_path': root_path_kwarg,
                         'storage_options': storage_options}
 
 
+def _consolidated_metadata_is_current(zarr_root, group_paths=("", "properties")):
+    """
+    Check that the consolidated metadata list the same arrays and groups as the store itself
+    in the groups that can get new members after saving (the root and the properties).
+    Each group is listed with one request, the chunks are not listed.
+    """
+    for group_path in group_paths:
+        consolidated_members = {name for name in zarr.storage.listdir(zarr_root.store, group_path)
+                                if not name.startswith(".")}
+        members = {name for name in zarr.storage.listdir(zarr_root.chunk_store, group_path)
+                   if not name.startswith(".")}
+        if consolidated_members != members:
+            return False
+    return True
+
+
+def _get_nbytes_stored(zarr_array):
+    # with consolidated metadata `nbytes_stored` is unknown (-1), so the chunks are sized directly
+    return zarr.storage.getsize(zarr_array.chunk_store, zarr_array.path)
+
+
 class ZarrRecordingSegment(BaseRecordingSegment):
-    def __init__(self, root, dataset_name, **time_kwargs):
+    def __init__(self, timeseries, **time_kwargs):
         BaseRecordingSegment.__init__(self, **time_kwargs)
-        self._timeseries = root[dataset_name]
+        self._timeseries = timeseries
 
     def get_num_samples(self) -> int:
         """Returns the number of samples in this signal block
@@ -146,9 +191,12 @@ class ZarrRecordingSegment(BaseRecordingSegment):
                    end_frame: Union[int, None] = None,
                    channel_indices: Union[List, None] = None,
                    ) -> np.ndarray:
-        traces = self._timeseries[start_frame:end_frame]
-        if channel_indices is not None:
-            traces = traces[:, channel_indices]
+        if channel_indices is None:
+            return self._timeseries[start_frame:end_frame]
+        if not isinstance(channel_indices, slice):
+            channel_indices = np.asarray(channel_indices)
+        # orthogonal selection only decompresses the chunks holding the requested channels
+        traces = self._timeseries.get_orthogonal_selection((slice(start_frame, end_frame), channel_indices))
         return traces
 
 
@@ -160,7 +208,17 @@ def read_zarr(*args, **kwargs):
 read_zarr.__doc__ = ZarrRecordingExtractor.__doc__
 
 
-def get_default_zarr_compressor(clevel=5):
+# compressor settings used when saving to zarr with a `compression_profile` and no `compressor`
+zarr_compression_profiles = {
+    # lz4 is faster to write than zstd, for a slightly lower compression ratio
+    "fast": dict(cname="lz4", clevel=1),
+    "balanced": dict(cname="zstd", clevel=5),
+    # much slower to write, for a higher compression ratio
+    "small": dict(cname="zstd", clevel=9),
+}
+
+
+def get_default_zarr_compressor(clevel=5, shuffle="bit", blocksize=0, cname="zstd"):
     """
     Return default Zarr compressor object for good preformance in int16 
     electrophysiology data.
@@ -174,6 +232,15 @@ def get_default_zarr_compressor(clevel=5):
     clevel : int, optional
         Compression level (higher -> more compressed).
         Minimum 1, maximum 9. By default 5
+    shuffle : "bit", "byte", or "none", optional
+        Shuffle filter applied before compression. The bit shuffle usually gives the best
+        compression ratio on int16 traces, the byte shuffle can be faster on some Blosc builds.
+        By default "bit"
+    blocksize : int, optional
+        Size in bytes of the internal Blosc blocks (0 lets Blosc choose it).
+        Blocks that fit in the CPU cache (e.g. 64-256 KiB) can speed up (de)compression. By default 0
+    cname : str, optional
+        Name of the Blosc codec ("zstd", "lz4", "lz4hc", "blosclz", "zlib"). By default "zstd"
 
     Returns
     -------
@@ -182,4 +249,6 @@ def get_default_zarr_compressor(clevel=5):
     """
     assert ZarrRecordingExtractor.installed, ZarrRecordingExtractor.installation_mesg
     from numcodecs import Blosc
-    return Blosc(cname="zstd", clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+    shuffles = {"bit": Blosc.BITSHUFFLE, "byte": Blosc.SHUFFLE, "none": Blosc.NOSHUFFLE}
+    assert shuffle in shuffles, f"'shuffle' must be one of {list(shuffles.keys())}"
+    return Blosc(cname=cname, clevel=clevel, shuffle=shuffles[shuffle], blocksize=blocksize)
@@ -147,14 +147,29 @@ class PhySortingSegment(BaseSortingSegment):
         BaseSortingSegment.__init__(self)
         self._all_spikes = all_spikes
         self._all_clusters = all_clusters
+        # spikes grouped by cluster, computed at the first query
+        self._grouped_spikes = None
+        self._unit_slices = None
+
+    def _group_spikes_by_unit(self):
+        all_spikes = self._all_spikes.ravel()
+        all_clusters = self._all_clusters.ravel()
+        # stable sort: the spikes of each unit keep their original order
+        order = np.argsort(all_clusters, kind='stable')
+        self._grouped_spikes = all_spikes[order]
+        clusters, starts, counts = np.unique(all_clusters[order], return_index=True, return_counts=True)
+        self._unit_slices = {cluster: slice(start, start + count)
+                             for cluster, start, count in zip(clusters.tolist(), starts, counts)}
 
     def get_unit_spike_train(self, unit_id, start_frame, end_frame):
-        spike_times = self._all_spikes[self._all_clusters == unit_id]
+        if self._unit_slices is None:
+            self._group_spikes_by_unit()
+        spike_times = self._grouped_spikes[self._unit_slices.get(unit_id, slice(0, 0))]
         if start_frame is not None:
             spike_times = spike_times[spike_times >= start_frame]
         if end_frame is not None:
             spike_times = spike_times[spike_times < end_frame]
-        return np.atleast_1d(spike_times.copy().squeeze())
+        return spike_times.copy()
 
 
 class PhySortingExtractor(BasePhyKilosortSortingExtractor):
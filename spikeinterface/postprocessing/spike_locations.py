@@ -82,9 +82,11 @@ class SpikeLocationsCalculator(BaseWaveformExtractorExtension):
 
         elif outputs == 'by_unit':
             locations_by_unit = []
-            for segment_index in range(recording.get_num_segments()):
-                i0 =np.searchsorted(self.spikes['segment_ind'], segment_index, side="left")
-                i1 =np.searchsorted(self.spikes['segment_ind'], segment_index, side="right")
+            num_segments = recording.get_num_segments()
+            # all segment boundaries in a single searchsorted call
+            segment_bounds = np.searchsorted(self.spikes['segment_ind'], np.arange(num_segments + 1), side="left")
+            for segment_index in range(num_segments):
+                i0, i1 = segment_bounds[segment_index], segment_bounds[segment_index + 1]
                 spikes = self.spikes[i0: i1]
                 locations = self._extension_data['spike_locations'][i0: i1]
                 
@@ -1,6 +1,21 @@
+import functools
+
 import numpy as np
 from tqdm.auto import tqdm, trange
-import scipy.interpolate
+from joblib import Parallel, delayed
+import scipy.sparse
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+try:
+    import fast_histogram
+    HAVE_FAST_HISTOGRAM = True
+except ImportError:
+    HAVE_FAST_HISTOGRAM = False
 
 
 possible_motion_estimation_methods = ['decentralized_registration', 'iterative_template_registration']
@@ -58,6 +73,11 @@ def estimate_motion(recording, peaks, peak_locations,
         Specific options for the chosen method. You can use `init_kwargs_dict(method)` to retrieve default params.
         * 'decentralized_registration' (see https://proceedings.neurips.cc/paper/2021/hash/b950ea26ca12daae142bd74dba4427c8-Abstract.html)
         * 'iterative_template_registration' (see https://www.science.org/doi/abs/10.1126/science.abf4588 - Kilosort2.5 method)
+        For 'decentralized_registration', 'n_jobs' sets the number of threads used to process
+        the non-rigid windows in parallel (default 1) and 'subpixel' refines the pairwise
+        displacements below bin_um (default False).
+        For 'iterative_template_registration', 'circular_shifts'=False shifts the histograms
+        with zero padding instead of circularly (default True).
     non_rigid_kwargs: None or dict.
         If None then the motion is consider as rigid.
         If dict then the motion is estimated in non rigid manner with fields:
@@ -119,7 +139,7 @@ def estimate_motion(recording, peaks, peak_locations,
     if non_rigid_kwargs is None:
         # unique block for all depths
         num_non_rigid_windows = 1
-        non_rigid_windows = [np.ones(num_spatial_bins, dtype='float64')]
+        non_rigid_windows = np.ones((1, num_spatial_bins), dtype='float64')
         spatial_bins_non_rigid = [spatial_bin_edges[num_spatial_bins // 2] + bin_um / 2]
     else:
         assert 'bin_step_um' in non_rigid_kwargs, "'non_rigid_kwargs' needs to specify the 'bin_step_um' field"
@@ -132,10 +152,8 @@ def estimate_motion(recording, peaks, peak_locations,
         spatial_bins_non_rigid = np.arange(num_non_rigid_windows) * bin_step_um + min_ + border
         # non rigid windows need to be pre-computed for upsample_to_histogram_bin option
         sigma_um = non_rigid_kwargs.get('sigma', 3) * bin_step_um
-        non_rigid_windows = []
-        for win_center in spatial_bins_non_rigid:
-            win = np.exp(-(spatial_bin_edges[:-1] - win_center) ** 2 / (sigma_um ** 2))
-            non_rigid_windows.append(win)
+        dist_to_centers = spatial_bin_edges[np.newaxis, :-1] - spatial_bins_non_rigid[:, np.newaxis]
+        non_rigid_windows = _gaussian_kernel(dist_to_centers, sigma_um)
         if output_extra_check:
             extra_check['non_rigid_windows'] = non_rigid_windows
 
@@ -148,7 +166,11 @@ def estimate_motion(recording, peaks, peak_locations,
                                      peak_locations,
                                      direction=direction,
                                      bin_duration_s=bin_duration_s,
-                                     spatial_bin_edges=spatial_bin_edges)
+                                     spatial_bin_edges=spatial_bin_edges,
+                                     engine=method_kwargs.get("histogram_engine", "numpy"),
+                                     torch_device=method_kwargs.get("torch_device", None))
+        # float32 is enough for the correlations and halves the memory traffic
+        motion_histogram = motion_histogram.astype(np.float32, copy=False)
         if output_extra_check:
             extra_check['motion_histogram'] = motion_histogram
             extra_check['pairwise_displacement_list'] = []
@@ -156,14 +178,11 @@ def estimate_motion(recording, peaks, peak_locations,
         # temporal bins are bin center
         temporal_bins = temporal_hist_bin_edges[:-1] + bin_duration_s // 2.
 
-        motion = []
-        windows_iter = non_rigid_windows
-        if progress_bar:
-            windows_iter = tqdm(windows_iter, desc="windows")
-        for i, win in enumerate(windows_iter):
-            window_slice = np.flatnonzero(win > 1e-5)
-            window_slice = slice(window_slice[0], window_slice[-1])
-            motion_hist = win[np.newaxis, window_slice] * motion_histogram[:, window_slice]
+        window_slices = get_windows_slices(non_rigid_windows)
+
+        def compute_window_motion(i):
+            window_slice = window_slices[i]
+            motion_hist = non_rigid_windows[i][np.newaxis, window_slice] * motion_histogram[:, window_slice]
             if verbose:
                 print(f'Computing pairwise displacement: {i + 1} / {len(non_rigid_windows)}')
 
@@ -179,10 +198,9 @@ def estimate_motion(recording, peaks, peak_locations,
                 corr_threshold=method_kwargs.get("corr_threshold", 0),
                 time_horizon_s=method_kwargs.get("time_horizon_s", None),
                 bin_duration_s=bin_duration_s,
+                subpixel=method_kwargs.get("subpixel", False),
                 progress_bar=False
             )
-            if output_extra_check:
-                extra_check['pairwise_displacement_list'].append(pairwise_displacement)
 
             if verbose:
                 print(f'Computing global displacement: {i + 1} / {len(non_rigid_windows)}')
@@ -196,8 +214,23 @@ def estimate_motion(recording, peaks, peak_locations,
                 lsqr_robust_n_iter=method_kwargs.get("lsqr_robust_n_iter", 20),
                 progress_bar=False,
             )
-            motion.append(one_motion[:, np.newaxis])
-        motion = np.concatenate(motion, axis=1)
+            return one_motion, pairwise_displacement
+
+        # windows are independent: they can be processed in parallel threads (FFT and BLAS release the GIL)
+        windows_iter = range(len(non_rigid_windows))
+        if progress_bar:
+            windows_iter = tqdm(windows_iter, desc="windows")
+        results = Parallel(n_jobs=method_kwargs.get("n_jobs", 1), prefer="threads")(
+            delayed(compute_window_motion)(i) for i in windows_iter)
+
+        # float64 like the displacements of compute_global_displacement() and the motion of the
+        # iterative_template_registration method: the output dtype does not depend on the method
+        # (and this (num_temporal_bins, num_non_rigid_windows) array is small)
+        motion = np.empty((temporal_bins.size, len(non_rigid_windows)), dtype='float64')
+        for i, (one_motion, pairwise_displacement) in enumerate(results):
+            motion[:, i] = one_motion
+            if output_extra_check:
+                extra_check['pairwise_displacement_list'].append(pairwise_displacement)
 
     elif method == "iterative_template_registration":
         motion_histograms, temporal_hist_bin_edges, spatial_hist_bin_edges = \
@@ -206,7 +239,9 @@ def estimate_motion(recording, peaks, peak_locations,
                                       direction=direction,
                                       num_amp_bins=method_kwargs['num_amp_bins'],
                                       bin_duration_s=bin_duration_s,
-                                      spatial_bin_edges=spatial_bin_edges)
+                                      spatial_bin_edges=spatial_bin_edges,
+                                      engine=method_kwargs.get("histogram_engine", "numpy"),
+                                      torch_device=method_kwargs.get("torch_device", None))
         # temporal bins are bin center
         temporal_bins = temporal_hist_bin_edges[:-1] + bin_duration_s // 2.
 
@@ -219,7 +254,10 @@ def estimate_motion(recording, peaks, peak_locations,
                                             num_shifts_block=method_kwargs['num_shifts_block'],
                                             smoothing_sigma=method_kwargs['smoothing_sigma'],
                                             kriging_p=method_kwargs['kriging_p'],
-                                            kriging_d=method_kwargs['kriging_d'])
+                                            kriging_d=method_kwargs['kriging_d'],
+                                            circular_shifts=method_kwargs.get("circular_shifts", True),
+                                            conv_engine=method_kwargs.get("conv_engine", "numpy"),
+                                            torch_device=method_kwargs.get("torch_device", None))
 
         # convert to um
         motion = -(shift_indices * bin_um)
@@ -234,7 +272,7 @@ def estimate_motion(recording, peaks, peak_locations,
         extra_check['spatial_hist_bin_edges'] = spatial_hist_bin_edges
 
     # replace nan by zeros
-    motion[np.isnan(motion)] = 0
+    np.nan_to_num(motion, copy=False, nan=0., posinf=np.inf, neginf=-np.inf)
 
     if clean_motion_kwargs is not None:
         motion = clean_motion_vector(motion, temporal_bins, bin_duration_s, **clean_motion_kwargs)
@@ -244,9 +282,8 @@ def estimate_motion(recording, peaks, peak_locations,
         upsample_to_histogram_bin = non_rigid_kwargs is not None
     
     if upsample_to_histogram_bin:
-        # do upsample
-        non_rigid_windows = np.array(non_rigid_windows)
-        non_rigid_windows /= non_rigid_windows.sum(axis=0, keepdims=True)
+        # do upsample (a new array is allocated to leave extra_check['non_rigid_windows'] untouched)
+        non_rigid_windows = non_rigid_windows / non_rigid_windows.sum(axis=0, keepdims=True)
         spatial_bins_non_rigid = spatial_bin_edges[:-1] + bin_um / 2
         motion = motion @ non_rigid_windows
 
@@ -269,10 +306,33 @@ def get_spatial_bin_edges(recording, direction, margin_um, bin_um):
     return spatial_bins
 
 
+def get_windows_slices(non_rigid_windows, threshold=1e-5):
+    """
+    Get the slices of spatial bins covering each non-rigid window (where the window is above threshold).
+
+    Parameters
+    ----------
+    non_rigid_windows : np.array or list
+        Windows with shape (num_non_rigid_windows, num_spatial_bins)
+    threshold : float, optional
+        Window values below this threshold are ignored, by default 1e-5
+
+    Returns
+    -------
+    window_slices : list of slice
+        One slice per window
+    """
+    windows_mask = np.asarray(non_rigid_windows) > threshold
+    first_inds = np.argmax(windows_mask, axis=1)
+    last_inds = windows_mask.shape[1] - 1 - np.argmax(windows_mask[:, ::-1], axis=1)
+    window_slices = [slice(first, last) for first, last in zip(first_inds, last_inds)]
+    return window_slices
+
+
 def make_2d_motion_histogram(recording, peaks, peak_locations,
                              weight_with_amplitude=False, direction='y',
                              bin_duration_s=1., bin_um=2., margin_um=50,
-                             spatial_bin_edges=None):
+                             spatial_bin_edges=None, engine="numpy", torch_device=None):
     """
     Generate 2d motion histogram in depth and time.
 
@@ -297,6 +357,11 @@ def make_2d_motion_histogram(recording, peaks, peak_locations,
         Ignored if spatial_bin_edges is given.
     spatial_bin_edges : np.array, optional
         The pre-computed spatial bin edges, by default None
+    engine : str, optional
+        "numpy" or "torch", by default "numpy".
+        With "torch", the histogram is computed with torch.bincount on torch_device (only for regular bins).
+    torch_device : str or torch.device, optional
+        The torch device used when engine="torch". If None, "cuda" is used if available, by default None
 
     Returns
     -------
@@ -315,20 +380,39 @@ def make_2d_motion_histogram(recording, peaks, peak_locations,
     if spatial_bin_edges is None:
         spatial_bin_edges = get_spatial_bin_edges(recording, direction, margin_um, bin_um)
 
-    arr = np.zeros((peaks.size, 2), dtype='float64')
-    arr[:, 0] = peaks['sample_ind']
-    arr[:, 1] = peak_locations[direction]
-
     if weight_with_amplitude:
         weights = np.abs(peaks['amplitude'])
     else:
         weights = None
 
-    motion_histogram, edges = np.histogramdd(arr, bins=(sample_bin_edges, spatial_bin_edges), weights=weights)
+    # peaks fields are passed as separate contiguous 1d arrays
+    arr_x = peaks['sample_ind'].astype(np.float64)
+    arr_y = np.ascontiguousarray(peak_locations[direction], dtype=np.float64)
+
+    if engine == "torch" and _is_uniform(sample_bin_edges) and _is_uniform(spatial_bin_edges):
+        all_bin_edges = (sample_bin_edges, spatial_bin_edges)
+        motion_histogram = _histogram_torch((arr_x, arr_y), all_bin_edges, weights=weights, torch_device=torch_device)
+        if weight_with_amplitude:
+            bin_counts = _histogram_torch((arr_x, arr_y), all_bin_edges, torch_device=torch_device)
+    elif HAVE_FAST_HISTOGRAM and _is_uniform(sample_bin_edges) and _is_uniform(spatial_bin_edges):
+        # regular bins: the bin index is computed arithmetically instead of a searchsorted per peak
+        all_bin_edges = (sample_bin_edges, spatial_bin_edges)
+        motion_histogram = _histogram_fast_histogram(arr_x, arr_y, all_bin_edges, weights=weights)
+        if weight_with_amplitude:
+            bin_counts = _histogram_fast_histogram(arr_x, arr_y, all_bin_edges)
+    elif _is_uniform(sample_bin_edges) and _is_uniform(spatial_bin_edges):
+        all_bin_edges = (sample_bin_edges, spatial_bin_edges)
+        motion_histogram = _histogram_bincount((arr_x, arr_y), all_bin_edges, weights=weights)
+        if weight_with_amplitude:
+            bin_counts = _histogram_bincount((arr_x, arr_y), all_bin_edges)
+    else:
+        motion_histogram, edges = np.histogramdd((arr_x, arr_y), bins=(sample_bin_edges, spatial_bin_edges),
+                                                 weights=weights)
+        if weight_with_amplitude:
+            bin_counts, _ = np.histogramdd((arr_x, arr_y), bins=(sample_bin_edges, spatial_bin_edges))
 
     # average amplitude in each bin
     if weight_with_amplitude:
-        bin_counts, _ = np.histogramdd(arr, bins=(sample_bin_edges, spatial_bin_edges))
         bin_counts[bin_counts == 0] = 1
         motion_histogram = motion_histogram / bin_counts
 
@@ -338,7 +422,8 @@ def make_2d_motion_histogram(recording, peaks, peak_locations,
 def make_3d_motion_histograms(recording, peaks, peak_locations,
                               direction='y', bin_duration_s=1., bin_um=2.,
                               margin_um=50, num_amp_bins=20,
-                              log_transform=True, spatial_bin_edges=None):
+                              log_transform=True, spatial_bin_edges=None,
+                              engine="numpy", torch_device=None):
     """
     Generate 3d motion histograms in depth, amplitude, and time.
     This is used by the "iterative_template_registration" (Kilosort2.5) method.
@@ -364,6 +449,12 @@ def make_3d_motion_histograms(recording, peaks, peak_locations,
         If True, histograms are log-transformed, by default True
     spatial_bin_edges : np.array, optional
         The pre-computed spatial bin edges, by default None
+    engine : str, optional
+        "numpy" or "torch", by default "numpy".
+        With "torch", the histogram is computed with torch.bincount on torch_device (only for regular bins).
+        With "numpy", numba is used for regular bins when there are more than _numba_histogram_min_peaks peaks.
+    torch_device : str or torch.device, optional
+        The torch device used when engine="torch". If None, "cuda" is used if available, by default None
 
     Returns
     -------
@@ -384,19 +475,25 @@ def make_3d_motion_histograms(recording, peaks, peak_locations,
 
     # pre-compute abs amplitude and ranges for scaling
     amplitude_bin_edges = np.linspace(0, 1, num_amp_bins + 1)
-    abs_peaks = np.abs(peaks["amplitude"])
-    max_peak_amp = np.max(abs_peaks)
-    min_peak_amp = np.min(abs_peaks)
     # log amplitudes and scale between 0-1
-    abs_peaks_log_norm = (np.log10(abs_peaks) - np.log10(min_peak_amp)) / \
-        (np.log10(max_peak_amp) - np.log10(min_peak_amp))
-
-    arr = np.zeros((peaks.size, 3), dtype='float64')
-    arr[:, 0] = peaks['sample_ind']
-    arr[:, 1] = peak_locations[direction]
-    arr[:, 2] = abs_peaks_log_norm
-
-    motion_histograms, edges = np.histogramdd(arr, bins=(sample_bin_edges, spatial_bin_edges, amplitude_bin_edges,))
+    abs_peaks_log = np.log10(np.abs(peaks["amplitude"]))
+    min_log_amp = np.min(abs_peaks_log)
+    abs_peaks_log_norm = (abs_peaks_log - min_log_amp) / (np.max(abs_peaks_log) - min_log_amp)
+
+    # peaks fields are passed as separate contiguous 1d arrays
+    arrs = (np.ascontiguousarray(peaks['sample_ind']),
+            np.ascontiguousarray(peak_locations[direction]),
+            abs_peaks_log_norm)
+
+    all_bin_edges = (sample_bin_edges, spatial_bin_edges, amplitude_bin_edges)
+    if engine == "torch" and all(_is_uniform(edges) for edges in all_bin_edges):
+        motion_histograms = _histogram_torch(arrs, all_bin_edges, torch_device=torch_device)
+    elif HAVE_NUMBA and peaks.size >= _numba_histogram_min_peaks and all(_is_uniform(edges) for edges in all_bin_edges):
+        motion_histograms = _histogram3d_uniform(*arrs, *all_bin_edges)
+    elif all(_is_uniform(edges) for edges in all_bin_edges):
+        motion_histograms = _histogram_bincount(arrs, all_bin_edges)
+    else:
+        motion_histograms, edges = np.histogramdd(arrs, bins=all_bin_edges)
 
     if log_transform:
         motion_histograms = np.log2(1 + motion_histograms)
@@ -404,14 +501,172 @@ def make_3d_motion_histograms(recording, peaks, peak_locations,
     return motion_histograms, temporal_bin_edges, spatial_bin_edges
 
 
+def _is_uniform(bin_edges):
+    """Check that histogram bin edges are regularly spaced"""
+    steps = np.diff(bin_edges)
+    return steps.size > 0 and np.allclose(steps, steps[0])
+
+
+def _uniform_bins_params(bin_edges):
+    """Return (low, step, num_bins) for regularly spaced bin edges"""
+    num_bins = bin_edges.size - 1
+    return float(bin_edges[0]), float(bin_edges[-1] - bin_edges[0]) / num_bins, num_bins
+
+
+def _histogram_bincount(arrs, all_bin_edges, weights=None):
+    """
+    Histogram with regular bins computed with a single np.bincount on the flat bin indices.
+    Gives the same result as np.histogramdd (values on the last edge go into the last bin).
+    """
+    shape = tuple(edges.size - 1 for edges in all_bin_edges)
+    flat_inds = np.zeros(arrs[0].size, dtype=np.int64)
+    valid = np.ones(arrs[0].size, dtype=bool)
+    for arr, edges in zip(arrs, all_bin_edges):
+        values = np.asarray(arr, dtype=np.float64)
+        valid &= (values >= edges[0]) & (values <= edges[-1])
+        flat_inds *= edges.size - 1
+        flat_inds += _uniform_bin_indices(values, edges)
+
+    if weights is not None:
+        weights = weights[valid]
+    hist = np.bincount(flat_inds[valid], weights=weights, minlength=int(np.prod(shape)))
+
+    return hist.reshape(shape).astype(np.float64)
+
+
+def _uniform_bin_indices(values, edges):
+    """
+    Bin indices of values for regularly spaced edges, clipped to the bins.
+    The arithmetic index can be off by one for values on an edge (rounding errors), so it is
+    corrected by comparing with the edges themselves, like np.histogram does.
+    """
+    low, step, num_bins = _uniform_bins_params(edges)
+    inds = np.clip(np.floor((values - low) / step), 0, num_bins - 1).astype(np.int64)
+    inds -= (values < edges[inds]) & (inds > 0)
+    inds += (values >= edges[inds + 1]) & (inds < num_bins - 1)
+    return inds
+
+
+def _histogram_fast_histogram(arr_x, arr_y, all_bin_edges, weights=None):
+    """
+    2d histogram with regular bins computed with fast_histogram.
+    fast_histogram ignores the values on the last edge, and its arithmetic bin index can be off by one
+    for values on an edge: the values on (or very close to) an edge are binned again with
+    _histogram_bincount, so that the result is the same as np.histogramdd.
+    """
+    x_edges, y_edges = all_bin_edges
+    hist_range = [[x_edges[0], x_edges[-1]], [y_edges[0], y_edges[-1]]]
+    bins = (x_edges.size - 1, y_edges.size - 1)
+    hist = fast_histogram.histogram2d(arr_x, arr_y, range=hist_range, bins=bins, weights=weights)
+
+    near_edge = np.zeros(arr_x.size, dtype=bool)
+    for arr, edges in zip((arr_x, arr_y), all_bin_edges):
+        low, step, num_bins = _uniform_bins_params(edges)
+        position = (arr - low) / step
+        near_edge |= np.abs(position - np.round(position)) < 1e-6
+    if np.any(near_edge):
+        edge_x, edge_y = arr_x[near_edge], arr_y[near_edge]
+        edge_weights = None if weights is None else weights[near_edge]
+        hist -= fast_histogram.histogram2d(edge_x, edge_y, range=hist_range, bins=bins, weights=edge_weights)
+        hist += _histogram_bincount((edge_x, edge_y), all_bin_edges, weights=edge_weights)
+    return hist
+
+
+def _histogram_torch(arrs, all_bin_edges, weights=None, torch_device=None):
+    """
+    Histogram with regular bins computed with torch.bincount on torch_device.
+    Gives the same result as np.histogramdd (values on the last edge go into the last bin).
+    The histogram is returned as a float64 numpy array.
+    """
+    import torch
+    if torch_device is None:
+        torch_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    shape = tuple(edges.size - 1 for edges in all_bin_edges)
+    flat_inds = None
+    valid = None
+    for arr, edges in zip(arrs, all_bin_edges):
+        low, step, num_bins = _uniform_bins_params(edges)
+        values = torch.as_tensor(arr, dtype=torch.float64, device=torch_device)
+        edges_t = torch.as_tensor(edges, dtype=torch.float64, device=torch_device)
+        in_range = (values >= edges_t[0]) & (values <= edges_t[-1])
+        inds = torch.clamp(torch.floor((values - low) / step), 0, num_bins - 1).long()
+        # off by one on the edges because of rounding errors: compare with the edges themselves
+        inds -= ((values < edges_t[inds]) & (inds > 0)).long()
+        inds += ((values >= edges_t[inds + 1]) & (inds < num_bins - 1)).long()
+        valid = in_range if valid is None else valid & in_range
+        flat_inds = inds if flat_inds is None else flat_inds * num_bins + inds
+
+    if weights is not None:
+        weights = torch.as_tensor(weights, dtype=torch.float64, device=torch_device)[valid]
+    hist = torch.bincount(flat_inds[valid], weights=weights, minlength=int(np.prod(shape)))
+
+    return hist.reshape(shape).cpu().numpy().astype(np.float64)
+
+
+# below this number of peaks, the numba 3d histogram is slower than np.bincount once the time to
+# load (or compile) the numba kernel is included
+_numba_histogram_min_peaks = 10_000_000
+
+# maximum memory used by the per-thread histograms of _histogram3d_uniform
+_max_local_histograms_bytes = 512 * 1024 ** 2
+
+
+def _histogram3d_uniform(x, y, z, x_edges, y_edges, z_edges):
+    """
+    3d histogram with regular bins computed in parallel with numba.
+    Each thread fills a private histogram (no atomics) and they are summed at the end.
+    Gives the same result as np.histogramdd.
+    """
+    hist_nbytes = (x_edges.size - 1) * (y_edges.size - 1) * (z_edges.size - 1) * 8
+    num_blocks = min(numba.get_num_threads(), max(1, _max_local_histograms_bytes // hist_nbytes), max(1, x.size))
+    local_hists = _histogram3d_uniform_numba(x, y, z, *_uniform_bins_params(x_edges), x_edges,
+                                             *_uniform_bins_params(y_edges), y_edges,
+                                             *_uniform_bins_params(z_edges), z_edges, num_blocks)
+    return local_hists.sum(axis=0)
+
+
+if HAVE_NUMBA:
+    @numba.jit(nopython=True, cache=True)
+    def _uniform_bin_index_numba(value, low, step, num, edges):
+        # same as _uniform_bin_indices for one value in the edges range
+        ind = min(int((value - low) / step), num - 1)
+        if ind > 0 and value < edges[ind]:
+            ind -= 1
+        elif ind < num - 1 and value >= edges[ind + 1]:
+            ind += 1
+        return ind
+
+    @numba.jit(nopython=True, parallel=True, cache=True)
+    def _histogram3d_uniform_numba(x, y, z, x_low, x_step, x_num, x_edges, y_low, y_step, y_num, y_edges,
+                                   z_low, z_step, z_num, z_edges, num_blocks):
+        # bin indices are computed arithmetically, values on the last edge go into the last bin (like np.histogramdd)
+        local_hists = np.zeros((num_blocks, x_num, y_num, z_num), dtype=np.float64)
+        block_size = (x.size + num_blocks - 1) // num_blocks
+        for block_index in numba.prange(num_blocks):
+            hist = local_hists[block_index]
+            for k in range(block_index * block_size, min((block_index + 1) * block_size, x.size)):
+                if not (x_edges[0] <= x[k] <= x_edges[-1] and y_edges[0] <= y[k] <= y_edges[-1]
+                        and z_edges[0] <= z[k] <= z_edges[-1]):
+                    continue
+                ix = _uniform_bin_index_numba(x[k], x_low, x_step, x_num, x_edges)
+                iy = _uniform_bin_index_numba(y[k], y_low, y_step, y_num, y_edges)
+                iz = _uniform_bin_index_numba(z[k], z_low, z_step, z_num, z_edges)
+                hist[ix, iy, iz] += 1
+        return local_hists
+
+
 def compute_pairwise_displacement(motion_hist, bin_um, method='conv',
                                   weight_scale='linear', error_sigma=0.2,
                                   conv_engine='numpy', torch_device=None,
                                   batch_size=1, max_displacement_um=1500,
                                   corr_threshold=0, time_horizon_s=None,
-                                  bin_duration_s=None, progress_bar=False): 
+                                  bin_duration_s=None, subpixel=False, progress_bar=False): 
     """
     Compute pairwise displacement
+
+    With method='conv' and subpixel=True, the displacement is refined below bin_um
+    with a parabola through the correlation maximum and its two neighbouring lags.
     """
     from scipy import sparse
     assert conv_engine in ("torch", "numpy")
@@ -443,59 +698,111 @@ def compute_pairwise_displacement(motion_hist, bin_um, method='conv',
         if conv_engine == "torch":
             motion_hist_engine = torch.as_tensor(motion_hist, dtype=torch.float32, device=torch_device)
 
+        padding = possible_displacement.size // 2
+        # the rfft and the per-lag means/variances of the histogram are computed once
+        # and shared by all batches
+        fft_length = get_xcorr_fft_length(motion_hist.shape[1], padding)
+        lags = np.arange(-padding, padding + 1)
+        x_prepared = _prepare_xcorr(motion_hist_engine, lags, fft_length, conv_engine)
+        template_prepared = _prepare_xcorr(motion_hist_engine, -lags, fft_length, conv_engine,
+                                           signals_fft=x_prepared[0])
+
         if time_horizon_s is not None and time_horizon_s > 0:
-            pairwise_displacement = sparse.dok_matrix((size, size), dtype=np.float32)
-            correlation = sparse.dok_matrix((size, size), dtype=motion_hist.dtype)
+            # pairs (i, j) with i < j inside the band are accumulated in coo arrays
+            max_num_pairs = size * max(band_width - 1, 0)
+            rows = np.empty(max_num_pairs, dtype=np.int64)
+            cols = np.empty(max_num_pairs, dtype=np.int64)
+            band_displacement = np.empty(max_num_pairs, dtype=np.float32)
+            band_correlation = np.empty(max_num_pairs, dtype=np.float32)
+            num_pairs = 0
 
             for i in xrange(size):
-                hist_i = motion_hist_engine[None, i]
-                pairwise_displacement[i, i] = 0
-                correlation[i, i] = 1
-                j_max = size if time_horizon_s is None else min(size, i + band_width)
-                for j in range(i + 1, j_max):
-                    corr = normxcorr1d(
-                        hist_i,
-                        motion_hist_engine[None, j],
-                        padding=possible_displacement.size // 2,
-                        conv_engine=conv_engine,
-                    )
-                    if conv_engine == "torch":
-                        max_corr, ind_max = torch.max(corr, dim=2)
-                        max_corr = max_corr.cpu()
-                        ind_max = ind_max.cpu()
-                    elif conv_engine == "numpy":
-                        ind_max = np.argmax(corr, axis=2)
-                        max_corr = corr[0, 0, ind_max]
-                    if max_corr > corr_threshold:
-                        pairwise_displacement[i, j] = -possible_displacement[ind_max]
-                        pairwise_displacement[j, i] = possible_displacement[ind_max]
-                        correlation[i, j] = correlation[j, i] = max_corr
-
-            pairwise_displacement = pairwise_displacement.tocsr()
-            correlation = correlation.tocsr()
+                # row i is correlated with all the following rows of the band at once
+                j_max = min(size, i + band_width)
+                if j_max <= i + 1:
+                    continue
+                corr = fft_normxcorr1d(
+                    motion_hist_engine[i : i + 1],
+                    motion_hist_engine[i + 1 : j_max],
+                    padding=padding,
+                    conv_engine=conv_engine,
+                    template_prepared=tuple(prepared[i : i + 1] for prepared in template_prepared),
+                    x_prepared=tuple(prepared[i + 1 : j_max] for prepared in x_prepared),
+                )
+                if conv_engine == "torch":
+                    max_corr, ind_max = torch.max(corr[:, 0], dim=1)
+                    max_corr = max_corr.cpu().numpy()
+                    ind_max = ind_max.cpu().numpy()
+                elif conv_engine == "numpy":
+                    ind_max = np.argmax(corr[:, 0], axis=1)
+                    max_corr = np.take_along_axis(corr[:, 0], ind_max[:, None], 1)[:, 0]
+                best_disp = possible_displacement[ind_max]
+                if subpixel:
+                    best_disp = best_disp + _parabolic_subpixel_shift(corr[:, 0], ind_max, conv_engine) * bin_um
+                keep = np.flatnonzero(max_corr > corr_threshold)
+                num_keep = keep.size
+                rows[num_pairs : num_pairs + num_keep] = i
+                cols[num_pairs : num_pairs + num_keep] = i + 1 + keep
+                band_displacement[num_pairs : num_pairs + num_keep] = -best_disp[keep]
+                band_correlation[num_pairs : num_pairs + num_keep] = max_corr[keep]
+                num_pairs += num_keep
+
+            rows = rows[:num_pairs]
+            cols = cols[:num_pairs]
+            band_displacement = band_displacement[:num_pairs]
+            band_correlation = band_correlation[:num_pairs]
+
+            # mirror the band: displacement is antisymmetric, correlation is symmetric with ones on the diagonal
+            diag = np.arange(size)
+            pairwise_displacement = sparse.coo_matrix(
+                (np.concatenate([band_displacement, -band_displacement]),
+                 (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                shape=(size, size), dtype=np.float32).tocsr()
+            pairwise_displacement.eliminate_zeros()
+            correlation = sparse.coo_matrix(
+                (np.concatenate([band_correlation, band_correlation, np.ones(size, dtype=np.float32)]),
+                 (np.concatenate([rows, cols, diag]), np.concatenate([cols, rows, diag]))),
+                shape=(size, size), dtype=np.float32).tocsr()
+            correlation.eliminate_zeros()
 
         else:
             pairwise_displacement = np.empty((size, size), dtype=np.float32)
-            correlation = np.empty((size, size), dtype=motion_hist.dtype)
+            correlation = np.empty((size, size), dtype=np.float32)
 
+            # displacement is antisymmetric and correlation symmetric: only the upper triangle
+            # (j >= i) is computed and mirrored
             for i in xrange(0, size, batch_size):
-                corr = normxcorr1d(
-                    motion_hist_engine,
-                    motion_hist_engine[i : i + batch_size],
-                    padding=possible_displacement.size // 2,
+                batch = slice(i, i + batch_size)
+                num_batch = min(batch_size, size - i)
+                corr = fft_normxcorr1d(
+                    motion_hist_engine[i:],
+                    motion_hist_engine[batch],
+                    padding=padding,
                     conv_engine=conv_engine,
+                    template_prepared=tuple(prepared[i:] for prepared in template_prepared),
+                    x_prepared=tuple(prepared[batch] for prepared in x_prepared),
                 )
                 if conv_engine == "torch":
                     max_corr, best_disp_inds = torch.max(corr, dim=2)
-                    best_disp = possible_displacement[best_disp_inds.cpu()]
-                    pairwise_displacement[i : i + batch_size] = best_disp
-                    correlation[i : i + batch_size] = max_corr.cpu()
+                    max_corr = max_corr.cpu().numpy()
+                    best_disp_inds = best_disp_inds.cpu().numpy()
                 elif conv_engine == "numpy":
                     best_disp_inds = np.argmax(corr, axis=2)
-                    max_corr = np.take_along_axis(corr, best_disp_inds[..., None], 2).squeeze()
-                    best_disp = possible_displacement[best_disp_inds]
-                    pairwise_displacement[i : i + batch_size] = best_disp
-                    correlation[i : i + batch_size] = max_corr
+                    max_corr = np.take_along_axis(corr, best_disp_inds[..., None], 2)[..., 0]
+                best_disp = possible_displacement[best_disp_inds]
+                if subpixel:
+                    best_disp = best_disp + _parabolic_subpixel_shift(corr, best_disp_inds, conv_engine) * bin_um
+
+                # square block on the diagonal
+                block_disp = best_disp[:, :num_batch]
+                block_corr = max_corr[:, :num_batch]
+                pairwise_displacement[batch, batch] = np.triu(block_disp) - np.triu(block_disp, 1).T
+                correlation[batch, batch] = np.triu(block_corr) + np.triu(block_corr, 1).T
+                # rectangle on the right of the block and its mirror below
+                pairwise_displacement[batch, i + num_batch:] = best_disp[:, num_batch:]
+                pairwise_displacement[i + num_batch:, batch] = -best_disp[:, num_batch:].T
+                correlation[batch, i + num_batch:] = max_corr[:, num_batch:]
+                correlation[i + num_batch:, batch] = max_corr[:, num_batch:].T
 
             if corr_threshold > 0:
                 which = correlation > corr_threshold
@@ -503,21 +810,33 @@ def compute_pairwise_displacement(motion_hist, bin_um, method='conv',
                 correlation *= which
 
     elif method == 'phase_cross_correlation':
-        try:
-            import skimage.registration
-        except ImportError:
-            raise ImportError("To use 'phase_cross_correlation' method install scikit-image")
+        # batched version of skimage.registration.phase_cross_correlation(motion_hist[i], motion_hist[j])
+        # (whole-pixel shift, "phase" normalization) for all pairs (i, j)
+        import scipy.fft
+
+        length = motion_hist.shape[1]
+        motion_hist_fft = scipy.fft.rfft(motion_hist, axis=1, workers=-1)
+        # normalized average intensity of each row (Parseval)
+        amps = np.sum(np.square(motion_hist, dtype='float64'), axis=1)
+        eps = np.finfo(motion_hist_fft.real.dtype).eps
+        midpoint = length // 2
 
         errors = np.zeros((size, size), dtype='float32')
-        loop = range(size)
+        loop = range(0, size, batch_size)
         if progress_bar:
             loop = tqdm(loop)
         for i in loop:
-            for j in range(size):
-                shift, error, diffphase = skimage.registration.phase_cross_correlation(motion_hist[i, :], 
-                                                                                       motion_hist[j, :])
-                pairwise_displacement[i, j] = shift * bin_um 
-                errors[i, j] = error
+            image_product = motion_hist_fft[i : i + batch_size, None, :] * np.conj(motion_hist_fft)[None, :, :]
+            image_product /= np.maximum(np.abs(image_product), 100 * eps)
+            # the product of the rfft of real signals is hermitian: the cross correlation is real
+            cross_correlation = scipy.fft.irfft(image_product, n=length, axis=2, workers=-1)
+            maxima = np.argmax(np.abs(cross_correlation), axis=2)
+            cc_max = np.take_along_axis(cross_correlation, maxima[..., None], 2)[..., 0]
+            shifts = np.where(maxima > midpoint, maxima - length, maxima)
+            pairwise_displacement[i : i + batch_size] = shifts * bin_um
+            with np.errstate(divide='ignore', invalid='ignore'):
+                error = 1.0 - np.square(cc_max) / (amps[i : i + batch_size, None] * amps[None, :])
+            errors[i : i + batch_size] = np.sqrt(np.abs(error))
         correlation = 1 - errors
         
     else:
@@ -532,6 +851,29 @@ def compute_pairwise_displacement(motion_hist, bin_um, method='conv',
     return pairwise_displacement, pairwise_displacement_weight
 
 
+def _parabolic_subpixel_shift(corr, max_inds, conv_engine="numpy"):
+    """
+    Offset (in lags, between -0.5 and 0.5) of the maximum of the parabola through corr at
+    max_inds - 1, max_inds and max_inds + 1 along the last axis.
+    The offset is 0 when the maximum is on the first or last lag.
+    """
+    num_lags = corr.shape[-1]
+    neighbour_inds = np.stack([max_inds - 1, max_inds, max_inds + 1], axis=-1)
+    neighbour_inds = np.clip(neighbour_inds, 0, num_lags - 1)
+    if conv_engine == "torch":
+        import torch
+        neighbour_inds = torch.as_tensor(neighbour_inds, device=corr.device)
+        neighbours = torch.gather(corr, corr.ndim - 1, neighbour_inds).cpu().numpy()
+    else:
+        neighbours = np.take_along_axis(corr, neighbour_inds, axis=-1)
+    y0, y1, y2 = (neighbours[..., k].astype('float64') for k in range(3))
+    curvature = y0 - 2 * y1 + y2
+    valid = (max_inds > 0) & (max_inds < num_lags - 1) & (curvature < 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(valid, 0.5 * (y0 - y2) / curvature, 0.)
+    return np.clip(shift, -0.5, 0.5)
+
+
 def compute_global_displacement(
     pairwise_displacement,
     pairwise_displacement_weight=None,
@@ -561,7 +903,7 @@ def compute_global_displacement(
         from scipy.optimize import minimize
         from scipy.sparse import csr_matrix
 
-        D = pairwise_displacement
+        D = np.asarray(pairwise_displacement, dtype=np.float32)
         if pairwise_displacement_weight is not None or sparse_mask is not None:
             # weighted problem
             if pairwise_displacement_weight is None:
@@ -571,40 +913,53 @@ def compute_global_displacement(
             W = pairwise_displacement_weight * sparse_mask
 
             I, J = np.where(W > 0)
-            Wij = W[I, J]
-            Dij = D[I, J]
+            # the sparse terms are accumulated in float64 so that obj and jac stay consistent
+            Wij = W[I, J].astype(np.float64)
+            Dij = D[I, J].astype(np.float64)
             W = csr_matrix((Wij, (I, J)), shape=W.shape)
-            WD = csr_matrix((Wij * Dij, (I, J)), shape=W.shape)
-            fixed_terms = (W @ WD).diagonal() - (WD @ W).diagonal()
-            diag_WW = (W @ W).diagonal()
+            # diagonals of W @ WD - WD @ W and W @ W, i.e. sums over k of W_ik * W_ki * (D_ki - D_ik)
+            # and of W_ik * W_ki, computed on the nonzero entries only instead of with sparse products
+            WWt = W.multiply(W.T).tocoo()
+            WWt_D = WWt.data * (D[WWt.col, WWt.row] - D[WWt.row, WWt.col])
+            fixed_terms = np.bincount(WWt.row, WWt_D, minlength=size)
+            diag_WW = np.bincount(WWt.row, WWt.data, minlength=size)
             Wsq = W.power(2)
 
-            def obj(p):
-                return 0.5 * np.square(Wij * (Dij - (p[I] - p[J]))).sum()
-
-            def jac(p):
-                return fixed_terms - 2 * (Wsq @ p) + 2 * p * diag_WW
+            # terms of the expanded objective that do not depend on p
+            Wsq_ij = np.square(Wij, dtype='float64')
+            WsqD_ij = Wsq_ij * Dij
+            obj_constant = np.sum(WsqD_ij * Dij)
+            obj_linear = np.bincount(I, WsqD_ij, minlength=size) - np.bincount(J, WsqD_ij, minlength=size)
+            obj_diag = np.bincount(I, Wsq_ij, minlength=size) + np.bincount(J, Wsq_ij, minlength=size)
+
+            def obj_jac(p):
+                # 0.5 * sum_ij W_ij**2 * (D_ij - (p_i - p_j))**2 expanded and its gradient,
+                # sharing the only sparse matvec
+                Wsq_p = Wsq @ p
+                obj = 0.5 * (obj_constant - 2 * (p @ obj_linear) + p @ (obj_diag * p) - 2 * (p @ Wsq_p))
+                jac = fixed_terms - 2 * Wsq_p + 2 * p * diag_WW
+                return obj, jac
         else:
             # unweighted problem, it's faster when we have no weights
-            fixed_terms = -D.sum(axis=1) + D.sum(axis=0)
+            fixed_terms = -D.sum(axis=1, dtype=np.float64) + D.sum(axis=0, dtype=np.float64)
+            D2_sum = np.square(D, dtype='float64').sum()
 
-            def obj(p):
-                v = np.square((D - (p[:, None] - p[None, :]))).sum()
-                return 0.5 * v
-
-            def jac(p):
-                return fixed_terms + 2 * (size * p - p.sum())
+            def obj_jac(p):
+                # 0.5 * sum_ij (D_ij - (p_i - p_j))**2 expanded: O(size) instead of O(size**2) per call
+                p_sum = p.sum()
+                obj = 0.5 * (D2_sum + 2 * (p @ fixed_terms) + 2 * size * (p @ p) - 2 * p_sum ** 2)
+                jac = fixed_terms + 2 * (size * p - p_sum)
+                return obj, jac
 
         res = minimize(
-            fun=obj, jac=jac, x0=D.mean(axis=1), method="L-BFGS-B"
+            fun=obj_jac, jac=True, x0=D.mean(axis=1, dtype=np.float64), method="L-BFGS-B"
         )
         if not res.success:
             print("Global displacement gradient descent had an error")
         displacement = res.x
 
     elif convergence_method == 'lsqr_robust':
-        from scipy.sparse import csr_matrix
-        from scipy.sparse.linalg import lsqr
+        from scipy.sparse.linalg import lsmr
         from scipy.stats import zscore
 
         if sparse_mask is not None:
@@ -614,28 +969,28 @@ def compute_global_displacement(
         else:
             I, J = np.where(np.ones_like(pairwise_displacement, dtype=bool))
 
-        nnz_ones = np.ones(I.shape[0], dtype=pairwise_displacement.dtype)
-
         if pairwise_displacement_weight is not None:
             if isinstance(pairwise_displacement_weight, scipy.sparse.csr_matrix):
-                W = np.array(pairwise_displacement_weight[I, J]).T
+                W = np.array(pairwise_displacement_weight[I, J])[0]
             else:
-                W = pairwise_displacement_weight[I, J][:,None]
+                W = pairwise_displacement_weight[I, J]
         else:
-            W = nnz_ones[:, None]
+            W = np.ones(I.shape[0])
         if isinstance(pairwise_displacement, scipy.sparse.csr_matrix):
             V = np.array(pairwise_displacement[I, J])[0]
         else:
             V = pairwise_displacement[I, J]
-        M = csr_matrix((nnz_ones, (range(I.shape[0]), I)))
-        N = csr_matrix((nnz_ones, (range(I.shape[0]), J)))
-        A = M - N
-        idx = np.ones(A.shape[0], dtype=bool)
+        W = W.astype('float64')
+        V = V.astype('float64')
+        idx = np.arange(I.shape[0])
 
         xrange = trange if progress_bar else range
         for i in xrange(lsqr_robust_n_iter):
-            p = lsqr(A[idx].multiply(W[idx]), V[idx] * W[idx][:,0])[0]
-            idx = np.where(np.abs(zscore(A @ p - V)) <= robust_regression_sigma)
+            # the weighted difference operator p -> W * (p[I] - p[J]) is applied on the fly
+            # instead of building the sparse matrix A = M - N and its rows selection at each iteration
+            A = _weighted_difference_operator(I[idx], J[idx], W[idx], size)
+            p = lsmr(A, V[idx] * W[idx])[0]
+            idx = np.flatnonzero(np.abs(zscore(p[I] - p[J] - V)) <= robust_regression_sigma)
         displacement = p
 
     else:
@@ -644,12 +999,31 @@ def compute_global_displacement(
     return displacement
 
 
+def _weighted_difference_operator(I, J, W, size):
+    """
+    LinearOperator of shape (len(I), size) computing W * (p[I] - p[J])
+    (the weighted rows of A = M - N in the lsqr_robust method) and its transpose.
+    """
+    from scipy.sparse.linalg import LinearOperator
+
+    def matvec(p):
+        p = np.ravel(p)
+        return W * (p[I] - p[J])
+
+    def rmatvec(r):
+        r = W * np.ravel(r)
+        return np.bincount(I, r, minlength=size) - np.bincount(J, r, minlength=size)
+
+    return LinearOperator((I.shape[0], size), matvec=matvec, rmatvec=rmatvec, dtype='float64')
+
+
 def iterative_template_registration(spikecounts_hist_images,
                                     non_rigid_windows=None,
                                     num_shifts_global=15, num_iterations=10,
                                     non_rigid_window_overlap=0.5,
                                     num_shifts_block=5, smoothing_sigma=0.5,
-                                    kriging_sigma=1, kriging_p=2, kriging_d=2):
+                                    kriging_sigma=1, kriging_p=2, kriging_d=2,
+                                    circular_shifts=True, conv_engine="numpy", torch_device=None):
     """
     Alignment function implemented by Kilosort2.5 and ported from pykilosort:
     https://github.com/int-brain-lab/pykilosort/blob/ibl_prod/pykilosort/datashift2.py#L166
@@ -683,6 +1057,15 @@ def iterative_template_registration(spikecounts_hist_images,
         p parameter for kriging_kernel function
     kriging_d : float, optional
         d parameter for kriging_kernel function
+    circular_shifts : bool, optional
+        If True (Kilosort behavior), histograms are shifted circularly along the spatial axis
+        (like np.roll), so bins leaving one end of the probe come back on the other end.
+        If False, shifted histograms are padded with zeros instead, by default True
+    conv_engine : "numpy" or "torch", optional
+        With "torch", the histograms are moved once to torch_device and the shift covariances
+        and realignments are computed there with torch.fft, by default "numpy"
+    torch_device : str or torch.device, optional
+        Device for conv_engine="torch", by default cuda if available else cpu
 
     Returns
     -------
@@ -691,21 +1074,29 @@ def iterative_template_registration(spikecounts_hist_images,
     target_spikecount_hist
         Target histogram used for alignment (num_spatial_bins, num_amps_bins)
     """
-    from scipy.ndimage import gaussian_filter, gaussian_filter1d
+    from scipy.ndimage import gaussian_filter
 
     assert 0 <= non_rigid_window_overlap <= 1, "'non_rigid_window_overlap' can be between 0 and 1!"
     # F is y bins by amp bins by batches
     # ysamp are the coordinates of the y bins in um
-    spikecounts_hist_images = spikecounts_hist_images.swapaxes(0, 1).swapaxes(1, 2)
-    num_temporal_bins = spikecounts_hist_images.shape[2]
+    # (single contiguous copy so that the FFTs and reductions along axis 0 have a unit stride)
+    F = np.ascontiguousarray(spikecounts_hist_images.transpose(1, 2, 0), dtype='float32')
+    num_temporal_bins = F.shape[2]
+    if conv_engine == "torch":
+        import torch
+        if torch_device is None:
+            torch_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        F = torch.as_tensor(F, device=torch_device)
+    elif conv_engine != "numpy":
+        raise ValueError(f"Unknown conv_engine {conv_engine}")
 
     # look up and down this many y bins to find best alignment
-    shift_covs = np.zeros((2 * num_shifts_global + 1, num_temporal_bins))
+    # (float32 is enough for the covariances used to find the best shifts)
+    shift_covs = np.zeros((2 * num_shifts_global + 1, num_temporal_bins), dtype='float32')
     shifts = np.arange(-num_shifts_global, num_shifts_global + 1)
 
     # mean subtraction to compute covariance
-    F = spikecounts_hist_images
-    Fg = F - np.mean(F, axis=0)
+    Fg = F - F.mean(0)
 
     # initialize the target "frame" for alignment with a single sample
     # here we removed min(299, ...)
@@ -714,22 +1105,34 @@ def iterative_template_registration(spikecounts_hist_images,
 
     # first we do rigid registration by integer shifts
     # everything is iteratively aligned until most of the shifts become 0.
-    best_shifts = np.zeros((num_iterations, num_temporal_bins))
+    best_shifts = np.zeros((num_iterations, num_temporal_bins), dtype='float32')
+    num_spatial_bins = Fg.shape[0]
+    spatial_indices = np.arange(num_spatial_bins)
     for iteration in range(num_iterations):
-        for t, shift in enumerate(shifts):
-            # for each NEW potential shift, estimate covariance
-            Fs = np.roll(Fg, shift, axis=0)
-            shift_covs[t, :] = np.mean(Fs * F0, axis=(0, 1))
+        # for each NEW potential shift, estimate covariance (all shifts at once in the Fourier domain)
+        shift_covs[:, :] = _roll_shift_covariances(Fg, F0, shifts, conv_engine, circular=circular_shifts)
         if iteration + 1 < num_iterations:
             # estimate the best shifts
             imax = np.argmax(shift_covs, axis=0)
-            # align the data by these integer shifts
-            for t, shift in enumerate(shifts):
-                ibest = imax == t
-                Fg[:, :, ibest] = np.roll(Fg[:, :, ibest], shift, axis=0)
-                best_shifts[iteration, ibest] = shift
-            # new target frame based on our current best alignment
-            F0 = np.mean(Fg, axis=2)[:, :, np.newaxis]
+            best_shifts[iteration, :] = shifts[imax]
+            # align the data by these integer shifts: np.roll of each temporal bin by its best
+            # shift, done with a single gather
+            # and new target frame based on our current best alignment
+            roll_indices = spatial_indices[:, np.newaxis] - shifts[imax]
+            # with zero padding, the bins coming from outside of the probe are zeroed
+            inside = ((roll_indices >= 0) & (roll_indices < num_spatial_bins))[:, np.newaxis, :]
+            roll_indices %= num_spatial_bins
+            if conv_engine == "torch":
+                roll_indices = torch.as_tensor(roll_indices, device=Fg.device)
+                Fg = torch.take_along_dim(Fg, roll_indices[:, None, :], dim=0)
+                if not circular_shifts:
+                    Fg *= torch.as_tensor(inside, device=Fg.device)
+                F0 = Fg.mean(2, keepdim=True)
+            else:
+                Fg = np.take_along_axis(Fg, roll_indices[:, np.newaxis, :], axis=0)
+                if not circular_shifts:
+                    Fg *= inside
+                F0 = np.mean(Fg, axis=2)[:, :, np.newaxis]
     target_spikecount_hist = F0[:, :, 0]
 
     # now we figure out how to split the probe into nblocks pieces
@@ -739,69 +1142,187 @@ def iterative_template_registration(spikecounts_hist_images,
     # for each small block, we only look up and down this many samples to find
     # nonrigid shift
     shifts_block = np.arange(-num_shifts_block, num_shifts_block + 1)
-    num_shifts = len(shifts_block)
-    shift_covs_block = np.zeros((2 * num_shifts_block + 1, num_temporal_bins, num_non_rigid_windows))
+    shift_covs_block = np.zeros((2 * num_shifts_block + 1, num_temporal_bins, num_non_rigid_windows),
+                                dtype='float32')
 
     # this part determines the up/down covariance for each block without
     # shifting anything
+    window_slices = get_windows_slices(non_rigid_windows)
+    # the direct sums with numba are faster than the FFTs for the tapered windows, but only worth
+    # loading (or compiling) the numba kernel when there is enough work
+    num_amp_bins = F.shape[1]
+    block_work = shifts_block.size * num_amp_bins * num_temporal_bins * \
+        sum(window_slice.stop - window_slice.start for window_slice in window_slices)
+    use_numba = conv_engine == "numpy" and HAVE_NUMBA and shifts_block.size <= _numba_shift_covariances_max_shifts \
+        and block_work >= _numba_shift_covariances_min_work
     for window_index in range(num_non_rigid_windows):
         win = non_rigid_windows[window_index]
-        window_slice = np.flatnonzero(win > 1e-5)
-        window_slice = slice(window_slice[0], window_slice[-1])
-        tiled_window = win[window_slice, np.newaxis, np.newaxis]
-        Ftaper = Fg[window_slice] * np.tile(tiled_window, (1,) + Fg.shape[1:])
-        for t, shift in enumerate(shifts_block):
-            Fs = np.roll(Ftaper, shift, axis=0)
-            F0taper = F0[window_slice] * np.tile(tiled_window, (1,) + F0.shape[1:])
-            shift_covs_block[t, :, window_index] = np.mean(Fs * F0taper, axis=(0, 1))
+        window_slice = window_slices[window_index]
+        # the taper is broadcast over amplitudes and time
+        taper = np.asarray(win[window_slice, np.newaxis, np.newaxis], dtype='float32')
+        if conv_engine == "torch":
+            taper = torch.as_tensor(taper, device=Fg.device)
+        shift_covs_block[:, :, window_index] = _roll_shift_covariances(Fg[window_slice], F0[window_slice],
+                                                                       shifts_block, conv_engine, taper=taper,
+                                                                       circular=circular_shifts, use_numba=use_numba)
+    if conv_engine == "torch":
+        target_spikecount_hist = target_spikecount_hist.cpu().numpy()
 
     # gaussian smoothing:
     # here the original my_conv2_cpu is substituted with scipy gaussian_filters
-    shift_covs_block_smooth = shift_covs_block.copy()
     shifts_block_up = np.linspace(-num_shifts_block, num_shifts_block,
                                   (2 * num_shifts_block * 10) + 1)
-    # 1. 2d smoothing over time and blocks dimensions for each shift
-    for shift_index in range(num_shifts):
-        shift_covs_block_smooth[shift_index, :, :] = gaussian_filter(
-            shift_covs_block_smooth[shift_index, :, :], smoothing_sigma
-        )  # some additional smoothing for robustness, across all dimensions
-    # 2. 1d smoothing over shift dimension for each spatial block
-    for window_index in range(num_non_rigid_windows):
-        shift_covs_block_smooth[:, :, window_index] = gaussian_filter1d(
-            shift_covs_block_smooth[:, :, window_index], smoothing_sigma, axis=0
-        )  # some additional smoothing for robustness, across all dimensions
-    upsample_kernel = kriging_kernel(shifts_block[:, np.newaxis],
-                                     shifts_block_up[:, np.newaxis],
-                                     sigma=kriging_sigma, p=kriging_p, d=kriging_d)
+    # some additional smoothing for robustness, across all dimensions: the 2d smoothing over time
+    # and blocks for each shift followed by the 1d smoothing over shifts for each block is a
+    # separable 3d gaussian, applied in a single call
+    shift_covs_block_smooth = np.empty_like(shift_covs_block)
+    gaussian_filter(shift_covs_block, smoothing_sigma, output=shift_covs_block_smooth)
+    upsample_kernel = _upsample_kernel(num_shifts_block, kriging_sigma, kriging_p, kriging_d)
 
-    optimal_shift_indices = np.zeros((num_temporal_bins, num_non_rigid_windows))
-    for window_index in range(num_non_rigid_windows):
-        # using the upsampling kernel K, get the upsampled cross-correlation
-        # curves
-        upsampled_cov = upsample_kernel.T @ shift_covs_block_smooth[:, :, window_index]
-
-        # find the max index of these curves
-        imax = np.argmax(upsampled_cov, axis=0)
+    # using the upsampling kernel K, get the upsampled cross-correlation
+    # curves of all windows with a single matrix product
+    # (num_shifts_up, num_temporal_bins, num_non_rigid_windows)
+    upsampled_cov = np.tensordot(upsample_kernel.T, shift_covs_block_smooth, axes=(1, 0))
 
-        # add the value of the shift to the last row of the matrix of shifts
-        # (as if it was the last iteration of the main rigid loop )
-        best_shifts[num_iterations - 1, :] = shifts_block_up[imax]
+    # find the max index of these curves
+    imax = np.argmax(upsampled_cov, axis=0)
 
-        # the sum of all the shifts equals the final shifts for this block
-        optimal_shift_indices[:, window_index] = np.sum(best_shifts, axis=0)
+    # the sum of all the shifts of the main rigid loop plus the upsampled block shift
+    # (as if it was the last iteration of the main rigid loop) equals the final shifts for each block
+    optimal_shift_indices = np.sum(best_shifts[:num_iterations - 1], axis=0)[:, np.newaxis] + shifts_block_up[imax]
 
     return optimal_shift_indices, target_spikecount_hist, shift_covs_block
 
 
-def normxcorr1d(template, x, padding="same", conv_engine="torch"):
+# maximum memory used by the spectra of a chunk of temporal bins in _roll_shift_covariances
+_max_shift_covariances_chunk_bytes = 256 * 1024 ** 2
+# up to this number of shifts, the shift covariances of the non rigid windows are computed with direct
+# sums with numba (if available) when the total number of multiply-adds is above _numba_shift_covariances_min_work
+_numba_shift_covariances_max_shifts = 16
+_numba_shift_covariances_min_work = 250_000_000
+
+
+def _roll_shift_covariances(F, F0, shifts, conv_engine="numpy", taper=None, circular=True, use_numba=False):
+    """
+    Compute np.mean(np.roll(F, shift, axis=0) * F0, axis=(0, 1)) for all shifts at once
+    (or the same with F shifted with zero padding instead of rolled if circular=False).
+
+    The circular cross-correlation along the spatial axis is computed with FFTs and the sum
+    over the amplitude axis is done in the Fourier domain, so that F is never rolled.
+    The temporal bins are processed by chunks so that the working memory is bounded.
+
+    Parameters
+    ----------
+    F : np.array
+        Histograms (num_spatial_bins, num_amp_bins, num_temporal_bins)
+    F0 : np.array
+        Target (num_spatial_bins, num_amp_bins, 1)
+    shifts : np.array
+        Integer shifts along the spatial axis
+    conv_engine : "numpy" or "torch"
+        With "torch", F and F0 are tensors and the FFTs are done with torch.fft on their device
+    taper : np.array or None
+        Optional taper (num_spatial_bins, 1, 1) applied to both F and F0, chunk by chunk
+        (so that the tapered F is never allocated as a whole)
+    circular : bool
+        Circular shifts (np.roll) if True, else shifts with zero padding
+    use_numba : bool
+        Use direct sums with numba instead of FFTs (only for conv_engine="numpy")
+
+    Returns
+    -------
+    shift_covs : np.array
+        Covariances (num_shifts, num_temporal_bins)
+    """
+    num_spatial_bins, num_amp_bins, num_temporal_bins = F.shape
+    if use_numba and conv_engine == "numpy":
+        if taper is None:
+            taper = np.ones(num_spatial_bins, dtype=F.dtype)
+        shift_covs = _shift_covariances_numba(F, F0, np.asarray(shifts, dtype='int64'),
+                                              np.asarray(taper, dtype=F.dtype).reshape(-1), circular)
+        return shift_covs.astype(F.dtype, copy=False)
+
+    if circular:
+        fft_length = num_spatial_bins
+    else:
+        # long enough for the linear cross-correlation at all shifts
+        from scipy.fft import next_fast_len
+        fft_length = next_fast_len(num_spatial_bins + int(np.max(np.abs(shifts))), real=True)
+    if conv_engine == "torch":
+        import torch
+        rfft = lambda x: torch.fft.rfft(x, n=fft_length, dim=0)
+        irfft = lambda x: torch.fft.irfft(x, n=fft_length, dim=0)
+        conj = torch.conj
+        to_numpy = lambda x: x.cpu().numpy()
+        itemsize = F.element_size()
+    else:
+        import scipy.fft
+        rfft = lambda x: scipy.fft.rfft(x, n=fft_length, axis=0, workers=-1)
+        irfft = lambda x: scipy.fft.irfft(x, n=fft_length, axis=0, workers=-1)
+        conj = np.conj
+        to_numpy = lambda x: x
+        itemsize = F.itemsize
+
+    if taper is not None:
+        F0 = F0 * taper
+    F0_fft = rfft(F0[:, :, 0])
+    shift_inds = np.asarray(shifts) % fft_length
+    # complex spectra of the chunk and of its product with the target
+    bytes_per_temporal_bin = 2 * (fft_length // 2 + 1) * num_amp_bins * 2 * itemsize
+    chunk_size = max(1, _max_shift_covariances_chunk_bytes // bytes_per_temporal_bin)
+
+    shift_covs = []
+    for start in range(0, num_temporal_bins, chunk_size):
+        F_chunk = F[:, :, start:start + chunk_size]
+        if taper is not None:
+            F_chunk = F_chunk * taper
+        # sum_y F0[y] * F[y - shift] is the inverse transform of F0_fft * conj(F_fft)
+        cross_fft = (F0_fft[:, None, :] @ conj(rfft(F_chunk)))[:, 0, :]
+        cross = to_numpy(irfft(cross_fft))
+        shift_covs.append(cross[shift_inds])
+    shift_covs = np.concatenate(shift_covs, axis=1)
+    shift_covs /= num_spatial_bins * num_amp_bins
+    return shift_covs
+
+
+if HAVE_NUMBA:
+    @numba.jit(nopython=True, parallel=True, fastmath=True, cache=True)
+    def _shift_covariances_numba(F, F0, shifts, taper, circular):
+        # direct version of _roll_shift_covariances, the shifts are processed in parallel
+        # and the innermost loop over temporal bins is vectorized
+        num_spatial_bins, num_amp_bins, num_temporal_bins = F.shape
+        shift_covs = np.zeros((shifts.size, num_temporal_bins), dtype=np.float64)
+        for shift_index in numba.prange(shifts.size):
+            shift = shifts[shift_index]
+            acc = np.zeros(num_temporal_bins, dtype=np.float64)
+            for y in range(num_spatial_bins):
+                y_shifted = y - shift
+                if y_shifted < 0 or y_shifted >= num_spatial_bins:
+                    if not circular:
+                        continue
+                    y_shifted = y_shifted % num_spatial_bins
+                for a in range(num_amp_bins):
+                    weight = F0[y, a, 0] * taper[y] * taper[y_shifted]
+                    for t in range(num_temporal_bins):
+                        acc[t] += F[y_shifted, a, t] * weight
+            shift_covs[shift_index] = acc / (num_spatial_bins * num_amp_bins)
+        return shift_covs
+
+
+# signals longer than this are correlated with FFTs in normxcorr1d()
+_normxcorr1d_fft_min_length = 32
+
+
+def normxcorr1d(template, x, padding="same", conv_engine="torch", template_prepared=None):
     """normxcorr1d: 1-D normalized cross-correlation
 
     Returns the cross-correlation of `template` and `x` at spatial lags
     determined by `mode`. Useful for estimating the location of `template`
     within `x`.
-    This might not be the most efficient implementation -- ideas welcome.
     It uses a direct convolutional translation of the formula
         corr = (E[XY] - EX EY) / sqrt(var X * var Y)
+    For an integer padding and signals longer than 32 samples, fft_normxcorr1d()
+    is used instead.
 
     Arguments
     ---------
@@ -813,6 +1334,10 @@ def normxcorr1d(template, x, padding="same", conv_engine="torch"):
         How far to look? if unset, we'll use half the length
     assume_centered : bool
         Avoid a copy if your data is centered already.
+    template_prepared : tuple or None
+        Optional output of `prepare_normxcorr1d_template(template, padding, conv_engine)`,
+        to avoid recomputing the template statistics when many x are correlated with
+        the same templates.
 
     Returns
     -------
@@ -834,41 +1359,266 @@ def normxcorr1d(template, x, padding="same", conv_engine="torch"):
     num_inputs, length_ = template.shape
     assert length == length_
 
-    # compute expectations
-    if conv_engine == "torch":
-        ones = npx.ones((1, 1, length), dtype=x.dtype, device=x.device)
-    else:
-        ones = npx.ones((1, 1, length), dtype=x.dtype)
+    if template_prepared is None:
+        template_prepared = prepare_normxcorr1d_template(template, padding, conv_engine)
+
+    if _use_fft_normxcorr1d(length, padding):
+        # the direct convolutions are O(length**2) per pair: switch to FFTs for long signals
+        return fft_normxcorr1d(template, x, padding, conv_engine=conv_engine,
+                               template_prepared=template_prepared)
+
+    # expectations and variances (var X = E[X^2] - (EX)^2) over the overlapping parts
+    # come from cumulative sums, only the cross term needs a convolution
+    lags = _conv1d_lags(length, padding, conv_engine)
+    _, Et, var_template = template_prepared
+    Ex, var_x = _lagged_mean_var(x, lags, conv_engine)
     # how many points in each window? seems necessary to normalize
     # for numerical stability.
-    N = conv1d(ones, ones, padding=padding)
-    Et = conv1d(ones, template[:, None, :], padding=padding) / N
-    Ex = conv1d(x[:, None, :], ones, padding=padding) / N
+    N = _overlap_lengths(length, lags, x)
 
     # compute covariance
     corr = conv1d(x[:, None, :], template[:, None, :], padding=padding) / N
-    corr -= Ex * Et
-
-    # compute variances for denominator, using var X = E[X^2] - (EX)^2
-    var_template = conv1d(
-        ones, npx.square(template)[:, None, :], padding=padding
-    )
-    var_template = var_template / N - npx.square(Et)
-    var_x = conv1d(
-        npx.square(x)[:, None, :], ones, padding=padding
-    )
-    var_x = var_x / N - npx.square(Ex)
-
-    # now find the final normxcorr and get rid of NaNs in zero-variance areas
-    corr /= npx.sqrt(var_x * var_template)
-    corr[~npx.isfinite(corr)] = 0
+    corr -= Ex[:, None, :] * Et[None, :, :]
+
+    # now find the final normxcorr, 0 in zero-variance areas
+    corr *= _inverse_std(var_x, conv_engine)[:, None, :]
+    corr *= _inverse_std(var_template, conv_engine)[None, :, :]
+
+    return corr
+
+
+def prepare_normxcorr1d_template(template, padding="same", conv_engine="torch"):
+    """
+    Precompute the template statistics used by normxcorr1d(template, x, padding, conv_engine):
+    for each lag, the mean and variance of the part of the templates overlapping x, and
+    the rfft of the templates when the FFT version is used.
+
+    Arguments
+    ---------
+    template : tensor, shape (num_templates, length)
+        The reference template signal
+    padding : int or "same" or "valid"
+        Same as in normxcorr1d()
+    conv_engine : "numpy" or "torch"
+        Same as in normxcorr1d()
+
+    Returns
+    -------
+    template_prepared : tuple
+        To be given as `template_prepared` to normxcorr1d() with the same padding and conv_engine
+    """
+    length = template.shape[1]
+    if _use_fft_normxcorr1d(length, padding):
+        lags = np.arange(-padding, padding + 1)
+        return _prepare_xcorr(template, -lags, get_xcorr_fft_length(length, padding), conv_engine)
+    lags = _conv1d_lags(length, padding, conv_engine)
+    Et, var_template = _lagged_mean_var(template, -lags, conv_engine)
+    return None, Et, var_template
+
+
+def _use_fft_normxcorr1d(length, padding):
+    return isinstance(padding, int) and length > _normxcorr1d_fft_min_length
+
+
+def fft_normxcorr1d(template, x, padding, conv_engine="numpy", template_prepared=None, x_prepared=None):
+    """FFT version of normxcorr1d().
+
+    All the (num_inputs, num_templates) cross-correlations are computed at once
+    in the Fourier domain and the means/variances of the overlapping parts are
+    obtained from cumulative sums, instead of one time-domain convolution per pair.
+    The output is the same as `normxcorr1d(template, x, padding, conv_engine)`.
+
+    Arguments
+    ---------
+    template : array or tensor, shape (num_templates, length)
+        The reference template signal
+    x : array or tensor, 1d shape (length,) or 2d shape (num_inputs, length)
+        The signal in which to find `template`
+    padding : int
+        How far to look (lags from -padding to padding)
+    conv_engine : "numpy" or "torch"
+        With "numpy" scipy.fft is used with all available workers, with "torch" torch.fft
+        on the device of the inputs.
+    template_prepared, x_prepared : tuple or None
+        Optional precomputed rfft, means and variances of template and x given by
+        `_prepare_xcorr()` with lags `-lags` and `lags` respectively, where
+        lags = np.arange(-padding, padding + 1). Useful when the same signals are
+        correlated by batches.
+
+    Returns
+    -------
+    corr : array or tensor, shape (num_inputs, num_templates, 2 * padding + 1)
+    """
+    if conv_engine == "torch":
+        import torch
+        npx = torch
+    elif conv_engine == "numpy":
+        npx = np
+    else:
+        raise ValueError(f"Unknown conv_engine {conv_engine}")
+
+    x = npx.atleast_2d(x)
+    num_templates, length = template.shape
+    num_inputs, length_ = x.shape
+    assert length == length_
+
+    fft_length = get_xcorr_fft_length(length, padding)
+    lags = np.arange(-padding, padding + 1)
+    if template_prepared is None:
+        template_prepared = _prepare_xcorr(template, -lags, fft_length, conv_engine)
+    if x_prepared is None:
+        x_prepared = _prepare_xcorr(x, lags, fft_length, conv_engine)
+    template_fft, Et, var_template = template_prepared
+    x_fft, Ex, var_x = x_prepared
+
+    # cross[m, c, k] = sum_l x[m, l + lag_k] * template[c, l]
+    cross = _irfft(x_fft[:, None, :] * npx.conj(template_fft)[None, :, :], fft_length, conv_engine)
+    lag_inds = lags % fft_length
+    if conv_engine == "torch":
+        lag_inds = torch.as_tensor(lag_inds, device=cross.device)
+    cross = cross[:, :, lag_inds]
+
+    N = _overlap_lengths(length, lags, cross)
+    corr = cross / N
+    corr -= Ex[:, None, :] * Et[None, :, :]
+    corr *= _inverse_std(var_x, conv_engine)[:, None, :]
+    corr *= _inverse_std(var_template, conv_engine)[None, :, :]
 
     return corr
 
 
+def _prepare_xcorr(signals, lags, fft_length, conv_engine="numpy", signals_fft=None):
+    """
+    Precompute the part of fft_normxcorr1d() that only depends on one side:
+    the rfft of the signals and, for each lag, the mean and variance of the
+    samples overlapping a signal of the same length shifted by lag.
+    Use lags for the inputs x and -lags for the templates.
+
+    Returns
+    -------
+    signals_fft, mean, var : arrays or tensors, the last two with shape (num_signals, num_lags)
+    """
+    if signals_fft is None:
+        signals_fft = _rfft(signals, fft_length, conv_engine)
+    mean, var = _lagged_mean_var(signals, lags, conv_engine)
+    return signals_fft, mean, var
+
+
+def _lagged_mean_var(signals, lags, conv_engine="numpy"):
+    """
+    Mean and variance of the samples of each signal overlapping a signal of the same
+    length shifted by lag, for each lag: arrays or tensors with shape (num_signals, num_lags)
+    and the dtype of signals.
+    """
+    # the sums are in float64 to avoid cancellations in var for float32 signals
+    sums, sums_sq = _lagged_window_sums(signals, lags, conv_engine)
+    N = _overlap_lengths(signals.shape[1], lags, sums)
+    mean = sums / N
+    var = sums_sq / N - mean ** 2
+    if conv_engine == "torch":
+        return mean.to(signals.dtype), var.to(signals.dtype)
+    else:
+        return mean.astype(signals.dtype), var.astype(signals.dtype)
+
+
+def _conv1d_lags(length, padding, conv_engine="numpy"):
+    """
+    Lags of the outputs of conv1d(x, template, padding) (F.conv1d for torch and scipy_conv1d
+    for numpy) for x and template with the same length: output k is sum_l x[l + lags[k]] * template[l].
+    """
+    if isinstance(padding, int):
+        return np.arange(-padding, padding + 1)
+    elif padding == "valid":
+        return np.zeros(1, dtype=int)
+    elif padding == "same":
+        # torch pads (length - 1) // 2 on the left, scipy.signal.correlate centers the full output
+        left = (length - 1) // 2 if conv_engine == "torch" else length // 2
+        return np.arange(length) - left
+    else:
+        raise ValueError(f"Unknown padding {padding}")
+
+
+def _inverse_std(var, conv_engine="numpy"):
+    """
+    1 / sqrt(var), or 0 where var is not positive (flat signals or no overlap).
+    The normalized cross-correlations are scaled in place by the inverse standard
+    deviations of each side: there is no full size temporary for sqrt(var_x * var_template)
+    and no extra pass to remove the NaNs.
+    """
+    if conv_engine == "torch":
+        import torch
+        return torch.where(var > 0, torch.rsqrt(var), torch.zeros_like(var))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(var > 0, 1 / np.sqrt(var), 0).astype(var.dtype, copy=False)
+
+
+def _overlap_lengths(length, lags, like):
+    # number of overlapping samples for each lag, with the dtype/device of `like`
+    # (at least 1: where nothing overlaps the sums are 0, so are the means and variances)
+    N = np.maximum(length - np.abs(lags), 1)
+    if isinstance(like, np.ndarray):
+        return N.astype(like.dtype)
+    import torch
+    return torch.as_tensor(N, dtype=like.dtype, device=like.device)
+
+
+def get_xcorr_fft_length(length, padding):
+    """
+    FFT length used by fft_normxcorr1d(): at least length + padding to avoid
+    circular aliasing for all lags, rounded up to a fast size for the FFT.
+    """
+    from scipy.fft import next_fast_len
+    return next_fast_len(length + padding, real=True)
+
+
+def _rfft(signals, fft_length, conv_engine):
+    if conv_engine == "torch":
+        import torch
+        return torch.fft.rfft(signals, n=fft_length, dim=-1)
+    else:
+        import scipy.fft
+        return scipy.fft.rfft(signals, n=fft_length, axis=-1, workers=-1)
+
+
+def _irfft(spectrums, fft_length, conv_engine):
+    if conv_engine == "torch":
+        import torch
+        return torch.fft.irfft(spectrums, n=fft_length, dim=-1)
+    else:
+        import scipy.fft
+        return scipy.fft.irfft(spectrums, n=fft_length, axis=-1, workers=-1)
+
+
+def _lagged_window_sums(signals, lags, conv_engine="numpy"):
+    """
+    For each lag, sum and sum of squares of signals[:, j] with 0 <= j - lag < length,
+    i.e. the samples overlapping a signal of the same length shifted by lag.
+    The sums are computed in float64.
+    """
+    num_signals, length = signals.shape
+    lags = np.clip(lags, -length, length)
+    start = np.maximum(lags, 0)
+    stop = np.minimum(length, length + lags)
+
+    if conv_engine == "torch":
+        import torch
+        padded = torch.nn.functional.pad(signals.to(torch.float64), (1, 0))
+        cumsum = torch.cumsum(padded, dim=1)
+        cumsum_sq = torch.cumsum(torch.square(padded), dim=1)
+        start = torch.as_tensor(start, device=signals.device)
+        stop = torch.as_tensor(stop, device=signals.device)
+    else:
+        cumsum = np.zeros((num_signals, length + 1), dtype=np.float64)
+        np.cumsum(signals, axis=1, out=cumsum[:, 1:])
+        cumsum_sq = np.zeros((num_signals, length + 1), dtype=np.float64)
+        np.cumsum(np.square(signals, dtype=np.float64), axis=1, out=cumsum_sq[:, 1:])
+
+    return cumsum[:, stop] - cumsum[:, start], cumsum_sq[:, stop] - cumsum_sq[:, start]
+
+
 def scipy_conv1d(input, weights, padding="valid"):
     """SciPy translation of torch F.conv1d"""
-    from scipy.signal import correlate
+    from scipy.signal import fftconvolve
 
     n, c_in, length = input.shape
     c_out, in_by_groups, kernel_size = weights.shape
@@ -876,23 +1626,24 @@ def scipy_conv1d(input, weights, padding="valid"):
 
     if padding == "same":
         mode = "same"
-        length_out = length
     elif padding == "valid":
         mode = "valid"
-        length_out = length - 2 * (kernel_size // 2)
     elif isinstance(padding, int):
         mode = "valid"
         input = np.pad(input, [*[(0,0)] * (input.ndim - 1), (padding, padding)])
-        length_out = length - (kernel_size - 1) + 2 * padding
     else:
         raise ValueError(f"Unknown padding {padding}")
 
-    output = np.zeros((n, c_out, length_out), dtype=input.dtype)
-    for m in range(n):
-        for c in range(c_out):
-            output[m, c] = correlate(input[m, 0], weights[c, 0], mode=mode)
+    # correlating with weights is convolving with the flipped weights: all the (n, c_out)
+    # pairs are computed with a single broadcast FFT convolution, cropped like scipy.signal.correlate
+    output = fftconvolve(input, weights[np.newaxis, :, 0, ::-1], mode="full", axes=-1)
+    if mode == "same":
+        start = (output.shape[-1] - length) // 2
+        output = output[:, :, start : start + length]
+    else:
+        output = output[:, :, kernel_size - 1 : input.shape[-1]]
 
-    return output
+    return output.astype(input.dtype, copy=False)
 
 
 def clean_motion_vector(motion, temporal_bins, bin_duration_s, 
@@ -929,42 +1680,88 @@ def clean_motion_vector(motion, temporal_bins, bin_duration_s,
     #   * mask the period and interpolate
     for i in range(motion.shape[1]):
         one_motion = motion_clean[:, i]
-        speed = np.diff(one_motion, axis=0) / bin_duration_s
-        inds,  = np.nonzero(np.abs(speed) > speed_threshold)
-        inds +=1 
-        if inds.size % 2 == 1:
-            # more compicated case: number of of inds is odd must remove first or last
-            # take the smallest duration sum
-            inds0 = inds[:-1]
-            inds1 = inds[1:]
-            d0 = np.sum(inds0[1::2] - inds0[::2])
-            d1 = np.sum(inds1[1::2] - inds1[::2])
-            if d0 < d1:
-                inds = inds0
-        mask = np.ones(motion_clean.shape[0], dtype='bool')
-        for i in range(inds.size // 2):
-            mask[inds[i*2]:inds[i*2+1]] = False
-        f = scipy.interpolate.interp1d(temporal_bins[mask], one_motion[mask])
-        one_motion[~mask] = f(temporal_bins[~mask])
+        mask = _plateau_mask(one_motion, bin_duration_s, speed_threshold)
+        one_motion[~mask] = np.interp(temporal_bins[~mask], temporal_bins[mask], one_motion[mask])
     
     # Step 2 : gaussian smooth
     if sigma_smooth_s is not None:
-        half_size = motion_clean.shape[0] // 2
-        if motion_clean.shape[0] % 2 == 0:
-            # take care of the shift
-            bins = (np.arange(motion_clean.shape[0]) - half_size + 1) * bin_duration_s
-        else:
-            bins = (np.arange(motion_clean.shape[0]) - half_size) * bin_duration_s
-        smooth_kernel = np.exp( -bins**2 / ( 2 * sigma_smooth_s **2))
-        smooth_kernel /= np.sum(smooth_kernel)
-        smooth_kernel = smooth_kernel[:, None]
-        motion_clean = scipy.signal.fftconvolve(motion_clean, smooth_kernel, mode='same', axes=0)
+        from scipy.ndimage import gaussian_filter1d
+        # truncated gaussian with zero padding on the borders, like the previous full-length
+        # kernel convolution
+        motion_clean = gaussian_filter1d(motion_clean, sigma_smooth_s / bin_duration_s, axis=0,
+                                         mode='constant', cval=0., truncate=4.0)
     
     return motion_clean
 
 
+def _plateau_mask(one_motion, bin_duration_s, speed_threshold):
+    """
+    Mask of the bins of one motion vector kept by clean_motion_vector: False between
+    pairs of bins where the speed crosses speed_threshold.
+    """
+    speed = np.diff(one_motion) / bin_duration_s
+    inds,  = np.nonzero(np.abs(speed) > speed_threshold)
+    inds += 1
+    if inds.size % 2 == 1:
+        # more compicated case: number of of inds is odd must remove first or last
+        # take the smallest duration sum
+        inds0 = inds[:-1]
+        inds1 = inds[1:]
+        d0 = np.sum(inds0[1::2] - inds0[::2])
+        d1 = np.sum(inds1[1::2] - inds1[::2])
+        if d0 < d1:
+            inds = inds0
+    mask = np.ones(one_motion.size, dtype=np.bool_)
+    for j in range(inds.size // 2):
+        mask[inds[j * 2]:inds[j * 2 + 1]] = False
+    return mask
+
+
 def kriging_kernel(source_location, target_location, sigma=1, p=2, d=2):
-    from scipy.spatial.distance import cdist
-    dist_xy = cdist(source_location, target_location, metric='euclidean')
-    K = np.exp(-(dist_xy / sigma)**p / d)
+    source_location = np.asarray(source_location, dtype='float64')
+    target_location = np.asarray(target_location, dtype='float64')
+    # squared euclidean distances with one matrix product: |a|^2 + |b|^2 - 2 a.b
+    dist2_xy = source_location @ target_location.T
+    dist2_xy *= -2
+    dist2_xy += np.sum(source_location ** 2, axis=1)[:, np.newaxis]
+    dist2_xy += np.sum(target_location ** 2, axis=1)[np.newaxis, :]
+    np.maximum(dist2_xy, 0, out=dist2_xy)
+    if p == 2:
+        # no sqrt needed
+        dist2_xy /= -d * sigma ** 2
+        K = np.exp(dist2_xy, out=dist2_xy)
+    else:
+        K = _gaussian_kernel(np.sqrt(dist2_xy, out=dist2_xy), sigma, p=p, d=d)
     return K
+
+
+@functools.lru_cache(maxsize=32)
+def _upsample_kernel(num_shifts_block, kriging_sigma, kriging_p, kriging_d):
+    """
+    Kriging kernel from the integer block shifts to the shifts upsampled 10 times used
+    by iterative_template_registration. It only depends on the parameters so it is cached,
+    the returned array is read-only.
+    """
+    shifts_block = np.arange(-num_shifts_block, num_shifts_block + 1)
+    shifts_block_up = np.linspace(-num_shifts_block, num_shifts_block,
+                                  (2 * num_shifts_block * 10) + 1)
+    upsample_kernel = kriging_kernel(shifts_block[:, np.newaxis],
+                                     shifts_block_up[:, np.newaxis],
+                                     sigma=kriging_sigma, p=kriging_p, d=kriging_d)
+    upsample_kernel.flags.writeable = False
+    return upsample_kernel
+
+
+def _gaussian_kernel(dist, sigma, p=2, d=1):
+    """
+    Compute exp(-(|dist| / sigma) ** p / d), used for the non-rigid windows (p=2, d=1)
+    and the kriging kernel. The exponent is computed in place in a single array.
+    """
+    kernel = np.abs(dist) / sigma
+    if p == 2:
+        np.multiply(kernel, kernel, out=kernel)
+    else:
+        np.power(kernel, p, out=kernel)
+    kernel /= -d
+    np.exp(kernel, out=kernel)
+    return kernel
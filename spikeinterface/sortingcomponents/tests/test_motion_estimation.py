@@ -66,6 +66,11 @@ def test_motion_functions():
         motion_histogram, bin_um, method='conv')
     motion = compute_global_displacement(pairwise_displacement, convergence_method='gradient_descent')
 
+    # conv with subpixel refinement
+    pairwise_displacement_subpixel, _ = compute_pairwise_displacement(
+        motion_histogram, bin_um, method='conv', subpixel=True)
+    assert np.all(np.abs(pairwise_displacement_subpixel - pairwise_displacement) <= bin_um / 2)
+
     # phase_cross_correlation + gradient_descent_robust
     # not tested yet on GH because need skimage
     try:
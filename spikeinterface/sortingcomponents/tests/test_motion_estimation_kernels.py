@@ -0,0 +1,349 @@
+import pytest
+import numpy as np
+
+from spikeinterface.core import generate_recording
+
+from spikeinterface.sortingcomponents import motion_estimation
+from spikeinterface.sortingcomponents.motion_estimation import (estimate_motion, make_2d_motion_histogram,
+                                                                make_3d_motion_histograms, normxcorr1d,
+                                                                fft_normxcorr1d, prepare_normxcorr1d_template,
+                                                                compute_global_displacement,
+                                                                iterative_template_registration,
+                                                                clean_motion_vector)
+
+
+def make_peaks(seed=0, num_peaks=20000, duration=200.):
+    """Synthetic drifting peaks on a linear probe (no download needed)."""
+    rng = np.random.default_rng(seed)
+    recording = generate_recording(num_channels=16, sampling_frequency=1000., durations=[duration])
+    num_samples = recording.get_num_samples(segment_index=0)
+    contact_y = recording.get_channel_locations()[:, 1]
+
+    peaks = np.zeros(num_peaks, dtype=[('sample_ind', 'int64'), ('channel_ind', 'int64'),
+                                       ('amplitude', 'float64'), ('segment_ind', 'int64')])
+    peaks['sample_ind'] = np.sort(rng.integers(0, num_samples, num_peaks))
+    peaks['amplitude'] = -rng.uniform(20, 300, num_peaks)
+    peak_locations = np.zeros(num_peaks, dtype=[('x', 'float64'), ('y', 'float64')])
+    drift = 10 * np.sin(2 * np.pi * peaks['sample_ind'] / num_samples)
+    peak_locations['y'] = rng.uniform(contact_y.min(), contact_y.max(), num_peaks) + drift
+
+    return recording, peaks, peak_locations
+
+
+def _histogram_engines(ndim):
+    engines = ["histogramdd", "bincount"]
+    if ndim == 2 and motion_estimation.HAVE_FAST_HISTOGRAM:
+        engines.append("fast_histogram")
+    if ndim == 3 and motion_estimation.HAVE_NUMBA:
+        engines.append("numba")
+    try:
+        import torch
+        engines.append("torch")
+    except ImportError:
+        pass
+    return engines
+
+
+def _compute_histogram(engine, arrs, all_bin_edges, weights=None):
+    if engine == "histogramdd":
+        hist, _ = np.histogramdd(arrs, bins=all_bin_edges, weights=weights)
+    elif engine == "bincount":
+        hist = motion_estimation._histogram_bincount(arrs, all_bin_edges, weights=weights)
+    elif engine == "fast_histogram":
+        hist = motion_estimation._histogram_fast_histogram(*arrs, all_bin_edges, weights=weights)
+    elif engine == "numba":
+        hist = motion_estimation._histogram3d_uniform(*arrs, *all_bin_edges)
+    elif engine == "torch":
+        hist = motion_estimation._histogram_torch(arrs, all_bin_edges, weights=weights, torch_device="cpu")
+    return hist
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+@pytest.mark.parametrize("bin_um", [5., 0.7])
+def test_histogram_engines(ndim, bin_um):
+    rng = np.random.default_rng(42)
+    sample_bin_edges = np.arange(0, 100 * 1000 + 1000, 1000).astype('float64')
+    spatial_bin_edges = np.arange(-57.3, 300., bin_um)
+    amplitude_bin_edges = np.linspace(0, 1, 21)
+    all_bin_edges = (sample_bin_edges, spatial_bin_edges, amplitude_bin_edges)[:ndim]
+
+    # random values, some out of range, plus values exactly on every edge (including the last one)
+    arrs = []
+    for edges in all_bin_edges:
+        random_values = rng.uniform(edges[0] - 1, edges[-1] + 1, 5000)
+        on_edges = np.concatenate([edges] * 3)
+        arrs.append(np.concatenate([random_values, on_edges]))
+    num_values = min(arr.size for arr in arrs)
+    arrs = tuple(np.ascontiguousarray(rng.permutation(arr)[:num_values]) for arr in arrs)
+    arrs[0][:sample_bin_edges.size] = sample_bin_edges
+    arrs[1][:spatial_bin_edges.size] = spatial_bin_edges
+    weights = rng.uniform(1, 100, num_values)
+
+    ref_hist = _compute_histogram("histogramdd", arrs, all_bin_edges)
+    ref_weighted_hist = _compute_histogram("histogramdd", arrs, all_bin_edges, weights=weights)
+    for engine in _histogram_engines(ndim):
+        hist = _compute_histogram(engine, arrs, all_bin_edges)
+        assert np.array_equal(hist, ref_hist), f"{engine} differs from np.histogramdd"
+        if engine == "numba":
+            # the numba histogram is only used for the (unweighted) 3d histograms
+            continue
+        weighted_hist = _compute_histogram(engine, arrs, all_bin_edges, weights=weights)
+        assert np.allclose(weighted_hist, ref_weighted_hist), f"weighted {engine} differs from np.histogramdd"
+
+
+@pytest.mark.parametrize("weight_with_amplitude", [False, True])
+def test_make_2d_motion_histogram_engines(weight_with_amplitude, monkeypatch):
+    recording, peaks, peak_locations = make_peaks()
+    # the last spatial edge holds peaks
+    spatial_bin_edges = np.arange(-20., 320., 5.)
+    peak_locations['y'][:10] = spatial_bin_edges[-1]
+
+    monkeypatch.setattr(motion_estimation, "HAVE_FAST_HISTOGRAM", False)
+    ref_hist, _, _ = make_2d_motion_histogram(recording, peaks, peak_locations, bin_duration_s=2.,
+                                              spatial_bin_edges=spatial_bin_edges,
+                                              weight_with_amplitude=weight_with_amplitude)
+    monkeypatch.undo()
+    hist, _, _ = make_2d_motion_histogram(recording, peaks, peak_locations, bin_duration_s=2.,
+                                          spatial_bin_edges=spatial_bin_edges,
+                                          weight_with_amplitude=weight_with_amplitude)
+    assert np.allclose(hist, ref_hist)
+    # non uniform edges use np.histogramdd
+    spatial_bin_edges[-2] += 1.
+    nonuniform_hist, _, _ = make_2d_motion_histogram(recording, peaks, peak_locations, bin_duration_s=2.,
+                                                     spatial_bin_edges=spatial_bin_edges,
+                                                     weight_with_amplitude=weight_with_amplitude)
+    assert np.allclose(nonuniform_hist[:, :-2], ref_hist[:, :-2])
+
+
+@pytest.mark.skipif(not motion_estimation.HAVE_NUMBA, reason="numba is not installed")
+def test_make_3d_motion_histograms_numba(monkeypatch):
+    recording, peaks, peak_locations = make_peaks()
+    ref_hists, _, _ = make_3d_motion_histograms(recording, peaks, peak_locations, bin_duration_s=2.)
+    # force the numba path, which is only used above _numba_histogram_min_peaks by default
+    monkeypatch.setattr(motion_estimation, "_numba_histogram_min_peaks", 0)
+    hists, _, _ = make_3d_motion_histograms(recording, peaks, peak_locations, bin_duration_s=2.)
+    assert np.array_equal(hists, ref_hists)
+
+
+def _reference_normxcorr1d(template, x, lags):
+    # direct float64 computation of the normalized cross-correlation on the overlapping parts
+    length = template.shape[1]
+    corr = np.zeros((x.shape[0], template.shape[0], len(lags)))
+    for k, lag in enumerate(lags):
+        inds = np.arange(max(0, -lag), min(length, length - lag))
+        x_part = x[:, inds + lag].astype('float64')
+        template_part = template[:, inds].astype('float64')
+        x_part = x_part - x_part.mean(axis=1, keepdims=True)
+        template_part = template_part - template_part.mean(axis=1, keepdims=True)
+        cov = x_part @ template_part.T / inds.size
+        std = np.sqrt(np.mean(x_part ** 2, axis=1))[:, None] * np.sqrt(np.mean(template_part ** 2, axis=1))[None, :]
+        corr[:, :, k] = np.where(std > 1e-6, cov / np.where(std > 1e-6, std, 1), 0)
+    return corr
+
+
+@pytest.mark.parametrize("length", [20, 33, 100])
+@pytest.mark.parametrize("padding", ["valid", "same", 4, "half"])
+def test_normxcorr1d(length, padding):
+    rng = np.random.default_rng(0)
+    template = rng.normal(size=(3, length)).astype('float32')
+    template[0] = 1.
+    x = rng.normal(size=(5, length)).astype('float32')
+    if padding == "half":
+        padding = length // 2
+
+    corr = normxcorr1d(template, x, padding=padding, conv_engine="numpy")
+    lags = motion_estimation._conv1d_lags(length, padding)
+    # with padding="valid" only the zero lag is returned, for any length
+    assert corr.shape == (5, 3, lags.size)
+    assert np.allclose(corr, _reference_normxcorr1d(template, x, lags), atol=1e-5)
+    # flat templates have no correlation
+    assert np.all(corr[:, 0] == 0)
+
+    template_prepared = prepare_normxcorr1d_template(template, padding=padding, conv_engine="numpy")
+    corr_prepared = normxcorr1d(template, x, padding=padding, conv_engine="numpy",
+                                template_prepared=template_prepared)
+    assert np.array_equal(corr_prepared, corr)
+
+    if isinstance(padding, int):
+        # the FFT version is used for long signals, it must also be right for short ones
+        fft_corr = fft_normxcorr1d(template, x, padding, conv_engine="numpy")
+        assert np.allclose(fft_corr, _reference_normxcorr1d(template, x, lags), atol=1e-5)
+
+
+def _reference_shift_covariances(F, F0, shifts, taper, circular):
+    if taper is not None:
+        F = F * taper
+        F0 = F0 * taper
+    shift_covs = np.zeros((len(shifts), F.shape[2]))
+    for i, shift in enumerate(shifts):
+        F_shifted = np.roll(F, shift, axis=0)
+        if not circular:
+            if shift > 0:
+                F_shifted[:shift] = 0
+            elif shift < 0:
+                F_shifted[shift:] = 0
+        shift_covs[i] = np.mean(F_shifted * F0, axis=(0, 1))
+    return shift_covs
+
+
+@pytest.mark.parametrize("circular", [True, False])
+@pytest.mark.parametrize("with_taper", [False, True])
+@pytest.mark.parametrize("use_numba", [False, True])
+def test_roll_shift_covariances(circular, with_taper, use_numba):
+    if use_numba and not motion_estimation.HAVE_NUMBA:
+        pytest.skip("numba is not installed")
+    rng = np.random.default_rng(0)
+    F = rng.uniform(0, 5, (40, 6, 30)).astype('float32')
+    F0 = F.mean(axis=2, keepdims=True)
+    shifts = np.arange(-5, 6)
+    taper = np.hanning(40).astype('float32')[:, None, None] if with_taper else None
+
+    shift_covs = motion_estimation._roll_shift_covariances(F, F0, shifts, taper=taper, circular=circular,
+                                                           use_numba=use_numba)
+    ref_shift_covs = _reference_shift_covariances(F, F0, shifts, taper, circular)
+    assert np.allclose(shift_covs, ref_shift_covs, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("circular_shifts", [True, False])
+def test_iterative_template_registration_engines(circular_shifts, monkeypatch):
+    recording, peaks, peak_locations = make_peaks()
+    motion_histograms, _, spatial_bin_edges = make_3d_motion_histograms(recording, peaks, peak_locations,
+                                                                        bin_duration_s=2., bin_um=5.)
+    centers = np.linspace(spatial_bin_edges[0], spatial_bin_edges[-1], 5)
+    windows = np.exp(-(spatial_bin_edges[None, :-1] - centers[:, None]) ** 2 / (2 * 50. ** 2))
+
+    # shift covariances with the FFTs only
+    monkeypatch.setattr(motion_estimation, "_numba_shift_covariances_min_work", np.inf)
+    ref_shifts, ref_target, ref_covs = iterative_template_registration(motion_histograms, non_rigid_windows=windows,
+                                                                       circular_shifts=circular_shifts)
+    if motion_estimation.HAVE_NUMBA:
+        monkeypatch.setattr(motion_estimation, "_numba_shift_covariances_min_work", 0)
+        shifts, target, covs = iterative_template_registration(motion_histograms, non_rigid_windows=windows,
+                                                               circular_shifts=circular_shifts)
+        assert np.array_equal(shifts, ref_shifts)
+        assert np.allclose(target, ref_target, atol=1e-5)
+        assert np.allclose(covs, ref_covs, atol=1e-5)
+
+    if not circular_shifts:
+        # with zero padding the estimated shifts differ, but they stay in the searched range
+        circular_ref_shifts, _, _ = iterative_template_registration(motion_histograms, non_rigid_windows=windows)
+        assert ref_shifts.shape == circular_ref_shifts.shape
+        assert np.all(np.abs(ref_shifts) <= 15 + 5)
+
+
+def test_estimate_motion_options():
+    recording, peaks, peak_locations = make_peaks()
+    kwargs = dict(bin_duration_s=2., bin_um=5., non_rigid_kwargs=dict(bin_step_um=50))
+
+    motion, temporal_bins, spatial_bins = estimate_motion(recording, peaks, peak_locations, **kwargs)
+    # the non-rigid windows are processed in threads with the same results
+    motion_n_jobs, _, _ = estimate_motion(recording, peaks, peak_locations, method_kwargs=dict(n_jobs=2),
+                                          **kwargs)
+    assert np.array_equal(motion_n_jobs, motion)
+
+    engines = ["numpy"]
+    try:
+        import torch
+        engines.append("torch")
+    except ImportError:
+        pass
+    for method in ("decentralized_registration", "iterative_template_registration"):
+        ref_motion = None
+        for histogram_engine in engines:
+            motion, _, _ = estimate_motion(recording, peaks, peak_locations, method=method,
+                                           method_kwargs=dict(histogram_engine=histogram_engine,
+                                                              torch_device="cpu"), **kwargs)
+            if ref_motion is None:
+                ref_motion = motion
+            assert np.allclose(motion, ref_motion), f"{method} differs with histogram_engine={histogram_engine}"
+
+    motion_zero_padding, _, _ = estimate_motion(recording, peaks, peak_locations,
+                                                method="iterative_template_registration",
+                                                method_kwargs=dict(circular_shifts=False), **kwargs)
+    assert motion_zero_padding.shape == ref_motion.shape
+
+
+def _reference_clean_motion_vector(motion, temporal_bins, bin_duration_s, speed_threshold):
+    # direct translation with scipy.interpolate of the speed threshold cleaning
+    from scipy.interpolate import interp1d
+
+    motion_clean = motion.copy()
+    for i in range(motion.shape[1]):
+        one_motion = motion_clean[:, i]
+        inds, = np.nonzero(np.abs(np.diff(one_motion) / bin_duration_s) > speed_threshold)
+        inds += 1
+        if inds.size % 2 == 1:
+            inds0 = inds[:-1]
+            inds1 = inds[1:]
+            if np.sum(inds0[1::2] - inds0[::2]) < np.sum(inds1[1::2] - inds1[::2]):
+                inds = inds0
+        mask = np.ones(motion.shape[0], dtype=bool)
+        for j in range(inds.size // 2):
+            mask[inds[j * 2]:inds[j * 2 + 1]] = False
+        one_motion[~mask] = interp1d(temporal_bins[mask], one_motion[mask])(temporal_bins[~mask])
+    return motion_clean
+
+
+@pytest.mark.parametrize("num_bins", [200, 201])
+def test_clean_motion_vector(num_bins):
+    rng = np.random.default_rng(0)
+    motion = np.cumsum(rng.normal(0, 1, (num_bins, 3)), axis=0)
+    # bumps, one of them unfinished
+    motion[50:55] += 200
+    motion[120, 1] -= 150
+    motion[-3:, 2] += 100
+    temporal_bins = np.arange(num_bins) * 2. + 1.
+
+    motion_clean = clean_motion_vector(motion, temporal_bins, 2., speed_threshold=30)
+    ref_motion_clean = _reference_clean_motion_vector(motion, temporal_bins, 2., 30)
+    assert np.allclose(motion_clean, ref_motion_clean)
+    assert np.max(np.abs(np.diff(motion_clean[:, 0]))) < 30 * 2.
+
+    # the smoothing is a gaussian convolution with zero padding on the borders
+    from scipy.ndimage import convolve1d
+    sigma_bins = 5.
+    kernel_bins = np.arange(-4 * int(sigma_bins), 4 * int(sigma_bins) + 1)
+    kernel = np.exp(-kernel_bins ** 2 / (2 * sigma_bins ** 2))
+    ref_smooth = convolve1d(ref_motion_clean, kernel / kernel.sum(), axis=0, mode='constant')
+    motion_smooth = clean_motion_vector(motion, temporal_bins, 2., speed_threshold=30,
+                                        sigma_smooth_s=sigma_bins * 2.)
+    assert np.allclose(motion_smooth, ref_smooth)
+
+
+@pytest.mark.parametrize("sparse_weights", [False, True])
+def test_compute_global_displacement_lsqr_robust(sparse_weights):
+    import scipy.sparse
+    from scipy.sparse.linalg import lsqr
+    from scipy.stats import zscore
+
+    rng = np.random.default_rng(0)
+    size = 60
+    displacement = np.cumsum(rng.normal(0, 2, size))
+    pairwise_displacement = displacement[None, :] - displacement[:, None] + rng.normal(0, 0.5, (size, size))
+    pairwise_displacement[3, 40] += 50.
+    weights = rng.uniform(0.2, 1, (size, size))
+    weights[np.abs(np.arange(size)[:, None] - np.arange(size)[None, :]) > 20] = 0
+    if sparse_weights:
+        weights = scipy.sparse.csr_matrix(weights)
+        pairwise_displacement = scipy.sparse.csr_matrix(pairwise_displacement * (weights.toarray() > 0))
+
+    p = compute_global_displacement(pairwise_displacement, pairwise_displacement_weight=weights,
+                                    convergence_method='lsqr_robust', lsqr_robust_n_iter=5)
+
+    # reference: explicit sparse difference matrix and scipy lsqr
+    I, J = weights.nonzero()
+    W = np.asarray(weights[I, J]).ravel()
+    V = np.asarray(pairwise_displacement[I, J]).ravel()
+    A = scipy.sparse.csr_matrix((np.ones(I.size), (np.arange(I.size), I)), shape=(I.size, size)) - \
+        scipy.sparse.csr_matrix((np.ones(I.size), (np.arange(I.size), J)), shape=(I.size, size))
+    idx = np.arange(I.size)
+    for _ in range(5):
+        ref_p = lsqr(A[idx].multiply(W[idx, None]).tocsr(), V[idx] * W[idx], atol=1e-12, btol=1e-12)[0]
+        idx = np.flatnonzero(np.abs(zscore(A @ ref_p - V)) <= 2)
+    assert np.allclose(p, ref_p, atol=1e-3)
+
+
+if __name__ == '__main__':
+    test_histogram_engines(2, 0.7)
+    test_histogram_engines(3, 0.7)
+    test_make_2d_motion_histogram_engines(True, pytest.MonkeyPatch())